@@ -0,0 +1,260 @@
+from FileOperations import FileSystem
+from SystemInitializer import initialize_filesystem
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+IMAGE_SIZES_MB = [10, 100, 1000]
+# A directory bucket holds a few hundred entries, so the larger counts
+# measure directories spread over many buckets
+ENTRY_COUNTS = [100, 1000, 5000]
+FILE_SIZES = [0, 4096, 65536, 1 << 20]
+TREE_DEPTHS = [1, 8, 32]
+
+QUICK_IMAGE_SIZES_MB = [10, 100]
+QUICK_ENTRY_COUNTS = [100, 1000]
+QUICK_FILE_SIZES = [4096, 65536]
+QUICK_TREE_DEPTHS = [1, 8]
+
+# Cases whose files add up to more than this are skipped
+MAX_DATA_BYTES = 256 << 20
+# A cold sample needs a mount of its own, so there are fewer of them
+COLD_SAMPLES = 20
+WARM_SAMPLES = 100
+
+
+def summarize(latencies):
+    """Throughput and latency percentiles (in milliseconds) for a list of seconds."""
+    if not latencies:
+        return {'ops': 0}
+    ordered = sorted(latencies)
+    total = sum(ordered)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000
+
+    return {
+        'ops': len(ordered),
+        'seconds': total,
+        'ops_per_sec': len(ordered) / total if total else None,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def timed(calls):
+    """Run each zero-argument callable and return the per-call latencies."""
+    latencies = []
+    for call in calls:
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def drop_caches(image):
+    """Evict the image from the OS page cache where the platform allows it."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+class Runner:
+    """Runs benchmark cases against scratch images in workdir and collects results."""
+
+    def __init__(self, workdir, mount_options=None):
+        self.workdir = workdir
+        self.mount_options = mount_options or {}
+        self.results = []
+
+    def image(self, size_mb, total_inodes=None):
+        path = os.path.join(self.workdir, 'bench.dat')
+        if os.path.exists(path):
+            os.remove(path)
+        initialize_filesystem(path, size_mb, total_inodes=total_inodes)
+        return path
+
+    def mount(self, image, cold):
+        if cold:
+            drop_caches(image)
+        return FileSystem(image, **self.mount_options)
+
+    def record(self, benchmark, params, cache, latencies):
+        result = {'benchmark': benchmark, 'params': params, 'cache': cache}
+        result.update(summarize(latencies))
+        self.results.append(result)
+
+    def bench_mkfs(self, size_mb):
+        path = os.path.join(self.workdir, 'mkfs.dat')
+        latencies = timed([lambda: initialize_filesystem(path, size_mb)] * 3)
+        os.remove(path)
+        self.record('mkfs', {'size_mb': size_mb}, 'n/a', latencies)
+
+    def cold_and_warm(self, benchmark, params, image, names, warm_up, operation):
+        """Time operation(fs, name) for each of names, cold for the first half and warm for the rest.
+
+        The cold half runs first thing on a fresh mount with the OS cache
+        dropped, so every name's inode and blocks are read for the first
+        time; the warm half runs after warm_up(fs, names) has cached them.
+        """
+        half = len(names) // 2
+        with self.mount(image, cold=True) as fs:
+            self.record(benchmark, params, 'cold',
+                        timed([lambda name=name: operation(fs, name) for name in names[:half]]))
+            warm_up(fs, names[half:])
+            self.record(benchmark, params, 'warm',
+                        timed([lambda name=name: operation(fs, name) for name in names[half:]]))
+
+    def bench_files(self, entries, file_size):
+        """create, lookup, read, move and delete entries files of file_size bytes in one directory."""
+        # Room for every file twice over, and an inode for each
+        size_mb = entries * -(-file_size // 4096) * 4096 * 2 // (1 << 20) + 10
+        image = self.image(size_mb, entries + 64)
+        params = {'entries': entries, 'file_size': file_size, 'size_mb': size_mb}
+        payload = os.urandom(file_size)
+        names = [f'/src/f{i:05d}' for i in range(entries)]
+        moved = [name.replace('/src/', '/dst/') for name in names]
+        with self.mount(image, cold=False) as fs:
+            fs.mkdir('/src')
+            fs.mkdir('/dst')
+
+        def resolve_all(fs, names):
+            for name in names:
+                fs.read_inode(fs.resolve(name))
+
+        self.cold_and_warm('create', params, image, names,
+                           lambda fs, names: fs.listdir('/src'),
+                           lambda fs, name: fs.createFile(name, payload))
+        self.cold_and_warm('lookup', params, image, names, resolve_all,
+                           lambda fs, name: fs.resolve(name))
+        self.cold_and_warm('read', params, image, names,
+                           lambda fs, names: [fs.read_bytes(name) for name in names],
+                           lambda fs, name: fs.read_bytes(name))
+        self.cold_and_warm('move', params, image, names,
+                           lambda fs, names: (resolve_all(fs, names), fs.listdir('/dst')),
+                           lambda fs, name: fs.move(name, '/dst'))
+        self.cold_and_warm('delete', params, image, moved, resolve_all,
+                           lambda fs, name: fs.deleteFile(name))
+
+    def bench_tree(self, depth):
+        """mkdir, lookup and read at the bottom of a chain of depth directories.
+
+        Each cold sample is the first operation on a mount of its own with
+        the OS cache dropped; the warm samples share one mount.
+        """
+        image = self.image(10)
+        params = {'depth': depth, 'size_mb': 10}
+        paths = ['/' + '/'.join(f'd{i}' for i in range(level + 1)) for level in range(depth)]
+        bottom = paths[-1]
+        leaf = bottom + '/leaf'
+        with self.mount(image, cold=False) as fs:
+            for path in paths:
+                fs.mkdir(path)
+            fs.createFile(leaf, b'x' * 100)
+        cases = [
+            ('mkdir', lambda fs: fs.resolve(bottom), lambda fs, kind, i: fs.mkdir(f'{bottom}/{kind}{i}')),
+            ('lookup', lambda fs: fs.resolve(leaf), lambda fs, kind, i: fs.resolve(leaf)),
+            ('read', lambda fs: fs.read_bytes(leaf), lambda fs, kind, i: fs.read_bytes(leaf)),
+        ]
+        for benchmark, warm_up, operation in cases:
+            latencies = []
+            for i in range(COLD_SAMPLES):
+                with self.mount(image, cold=True) as fs:
+                    latencies += timed([lambda: operation(fs, 'cold', i)])
+            self.record(benchmark, params, 'cold', latencies)
+            with self.mount(image, cold=False) as fs:
+                warm_up(fs)
+                self.record(benchmark, params, 'warm',
+                            timed([lambda i=i: operation(fs, 'warm', i) for i in range(WARM_SAMPLES)]))
+
+    def run(self, image_sizes, entry_counts, file_sizes, depths):
+        for size_mb in image_sizes:
+            self.bench_mkfs(size_mb)
+        for file_size in file_sizes:
+            for entries in entry_counts:
+                if entries * file_size <= MAX_DATA_BYTES:
+                    self.bench_files(entries, file_size)
+        for depth in depths:
+            self.bench_tree(depth)
+        return self.results
+
+
+def run_benchmarks(quick=False, mount_options=None, workdir=None):
+    """Run the suite and return a JSON-serializable report."""
+    own_workdir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='fs-bench-')
+    try:
+        runner = Runner(workdir, mount_options)
+        if quick:
+            results = runner.run(QUICK_IMAGE_SIZES_MB, QUICK_ENTRY_COUNTS, QUICK_FILE_SIZES, QUICK_TREE_DEPTHS)
+        else:
+            results = runner.run(IMAGE_SIZES_MB, ENTRY_COUNTS, FILE_SIZES, TREE_DEPTHS)
+    finally:
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': quick,
+            'mount_options': mount_options or {},
+        },
+        'results': results,
+    }
+
+
+def _key(result):
+    return (result['benchmark'], result['cache'], json.dumps(result['params'], sort_keys=True))
+
+
+def compare(old_report, new_report, threshold=0.10, file=None):
+    """Print the change in p50 latency per case to file; return the cases slower by more than threshold.
+
+    Printed to stderr by default so the JSON report on stdout stays parseable.
+    """
+    file = file or sys.stderr
+    old = {_key(result): result for result in old_report['results']}
+    regressions = []
+    for result in new_report['results']:
+        before = old.get(_key(result))
+        if not before or not before.get('p50_ms') or 'p50_ms' not in result:
+            continue
+        change = result['p50_ms'] / before['p50_ms'] - 1
+        print(f"{result['benchmark']:8} {result['cache']:5} {json.dumps(result['params'])}: "
+              f"{before['p50_ms']:.3f} -> {result['p50_ms']:.3f} ms ({change:+.0%})", file=file)
+        if change > threshold:
+            regressions.append(result)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark filesystem operations.")
+    parser.add_argument('--quick', action='store_true', help="smaller parameter grid")
+    parser.add_argument('--no-journal', action='store_true', help="mount without the journal")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--compare', help="earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.quick, {'journal': False} if args.no_journal else None)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,252 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+
+class BlockCache:
+    """Write-back cache of image blocks with LRU eviction.
+
+    All reads and writes of a mounted image go through here. Blocks are
+    loaded on first use, modified in memory and written back either when
+    they are evicted or on sync(), which flushes dirty blocks in ascending
+    block order.
+
+    Runs of uncached blocks are fetched with one pread, and transfers
+    spanning more than a quarter of the cache bypass it altogether so a
+    large sequential read or write is a single system call that does not
+    flush the working set.
+
+    The cache is safe to share between threads: block bookkeeping is
+    guarded by one lock, while bypassing reads do their I/O outside it.
+    """
+
+    def __init__(self, f, block_size, capacity=256):
+        if capacity < 1:
+            raise ValueError("Block cache capacity must be at least 1.")
+        self.f = f
+        self.fd = f.fileno()
+        self.block_size = block_size
+        self.capacity = capacity
+        self.blocks = OrderedDict()  # block number -> bytearray, oldest first
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.writebacks = 0
+        self.bypassed = 0
+        self.lock = threading.RLock()
+
+    # All image I/O goes through these two, so it can be counted
+    def _pread(self, size, offset):
+        return os.pread(self.fd, size, offset)
+
+    def _pwrite(self, data, offset):
+        os.pwrite(self.fd, data, offset)
+
+    def _load(self, block_num):
+        block = self.blocks.get(block_num)
+        if block is not None:
+            self.hits += 1
+            self.blocks.move_to_end(block_num)
+            return block
+        self.misses += 1
+        data = self._pread(self.block_size, block_num * self.block_size)
+        block = bytearray(data.ljust(self.block_size, b'\x00'))
+        self._insert(block_num, block)
+        return block
+
+    def _insert(self, block_num, block):
+        self.blocks[block_num] = block
+        while len(self.blocks) > self.capacity:
+            old_num, old_block = self.blocks.popitem(last=False)
+            if old_num in self.dirty:
+                self._write_back(old_num, old_block)
+                self.dirty.discard(old_num)
+
+    def _write_back(self, block_num, block):
+        self._pwrite(block, block_num * self.block_size)
+        self.writebacks += 1
+
+    def read_block(self, block_num):
+        with self.lock:
+            return bytes(self._load(block_num))
+
+    def write_block(self, block_num, data):
+        with self.lock:
+            self._write_block(block_num, data)
+
+    def _write_block(self, block_num, data):
+        if len(data) == self.block_size:
+            # Whole-block writes never need the old contents from disk
+            if block_num in self.blocks:
+                self.blocks.move_to_end(block_num)
+            self._insert(block_num, bytearray(data))
+        else:
+            block = self._load(block_num)
+            block[:len(data)] = data
+        self.dirty.add(block_num)
+
+    def _bypass_limit(self):
+        return max(1, self.capacity // 4)
+
+    def _cached_in(self, first, last):
+        """Cached block numbers in [first, last], scanning whichever side is smaller."""
+        if len(self.blocks) < last - first + 1:
+            return [n for n in self.blocks if first <= n <= last]
+        return [n for n in range(first, last + 1) if n in self.blocks]
+
+    def read(self, offset, size):
+        if size <= 0:
+            return b''
+        block_size = self.block_size
+        first, start = divmod(offset, block_size)
+        last = (offset + size - 1) // block_size
+        count = last - first + 1
+        if count > self._bypass_limit():
+            # The lock is held across the read: a block evicted and written
+            # back meanwhile would otherwise be neither cached nor in data
+            with self.lock:
+                data = self._pread(count * block_size, first * block_size)
+                self.bypassed += 1
+                cached = self._cached_in(first, last)
+                if cached or len(data) < count * block_size:
+                    data = bytearray(data.ljust(count * block_size, b'\x00'))
+                    for n in cached:
+                        # Cached copies may be newer than the image
+                        data[(n - first) * block_size:(n - first + 1) * block_size] = self.blocks[n]
+                    data = bytes(data)
+            return data[start:start + size]
+        with self.lock:
+            return self._read_cached(first, last)[start:start + size]
+
+    def _read_cached(self, first, last):
+        block_size = self.block_size
+        chunks = []
+        block_num = first
+        while block_num <= last:
+            block = self.blocks.get(block_num)
+            if block is not None:
+                self.hits += 1
+                self.blocks.move_to_end(block_num)
+                chunks.append(block)
+                block_num += 1
+                continue
+            run_end = block_num
+            while run_end < last and run_end + 1 not in self.blocks:
+                run_end += 1
+            run = run_end - block_num + 1
+            data = self._pread(run * block_size, block_num * block_size)
+            data = data.ljust(run * block_size, b'\x00')
+            for i in range(run):
+                self.misses += 1
+                block = bytearray(data[i * block_size:(i + 1) * block_size])
+                self._insert(block_num + i, block)
+                chunks.append(block)
+            block_num = run_end + 1
+        return b''.join(chunks)
+
+    def view(self, offset, size):
+        return memoryview(self.read(offset, size))
+
+    def write(self, offset, data):
+        with self.lock:
+            self._write(offset, data)
+
+    def _write(self, offset, data):
+        view = memoryview(data)
+        block_size = self.block_size
+        block_num, start = divmod(offset, block_size)
+        if start:
+            count = min(block_size - start, len(view))
+            block = self._load(block_num)
+            block[start:start + count] = view[:count]
+            self.dirty.add(block_num)
+            view = view[count:]
+            block_num += 1
+        full = len(view) // block_size
+        if full > self._bypass_limit():
+            self.bypassed += 1
+            self._pwrite(view[:full * block_size], block_num * block_size)
+            for n in self._cached_in(block_num, block_num + full - 1):
+                del self.blocks[n]
+                self.dirty.discard(n)
+            view = view[full * block_size:]
+            block_num += full
+        while len(view) >= block_size:
+            self._write_block(block_num, view[:block_size])
+            view = view[block_size:]
+            block_num += 1
+        if len(view):
+            block = self._load(block_num)
+            block[:len(view)] = view
+            self.dirty.add(block_num)
+
+    def sync(self):
+        with self.lock:
+            for block_num in sorted(self.dirty):
+                self._write_back(block_num, self.blocks[block_num])
+            self.dirty.clear()
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.blocks.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'writebacks': self.writebacks,
+                'bypassed': self.bypassed,
+                'cached': len(self.blocks),
+                'dirty': len(self.dirty),
+            }
+
+
+class MappedImage:
+    """Memory-mapped image with the same interface as BlockCache.
+
+    Reads are served straight from the mapping; view() returns a
+    memoryview slice of it without copying. Views must be released
+    before close() can unmap the image.
+    """
+
+    def __init__(self, f, block_size, image_size):
+        self.f = f
+        self.block_size = block_size
+        if os.fstat(f.fileno()).st_size < image_size:
+            # Images are written only up to their last used block; extend
+            # sparsely so every block is addressable through the map.
+            os.ftruncate(f.fileno(), image_size)
+        self.map = mmap.mmap(f.fileno(), 0)
+
+    def read_block(self, block_num):
+        offset = block_num * self.block_size
+        return self.map[offset:offset + self.block_size]
+
+    def write_block(self, block_num, data):
+        offset = block_num * self.block_size
+        self.map[offset:offset + len(data)] = data
+
+    def read(self, offset, size):
+        return self.map[offset:offset + size]
+
+    def view(self, offset, size):
+        return memoryview(self.map)[offset:offset + size]
+
+    def write(self, offset, data):
+        self.map[offset:offset + len(data)] = data
+
+    def sync(self):
+        self.map.flush()
+
+    def close(self):
+        self.sync()
+        try:
+            self.map.close()
+        except BufferError:
+            pass  # A caller still holds a view; the map is released with it
+
+    def stats(self):
+        return {'mapped': len(self.map)}
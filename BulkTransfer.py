@@ -0,0 +1,225 @@
+from DataStrucures import Inode, DirectoryEntry
+from FileOperations import FileSystem
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+
+def _read_host_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _take_blocks(extents, count):
+    """Remove the first count blocks from a list of extents and return them as extents."""
+    taken = []
+    while count:
+        start, length = extents[0]
+        used = min(length, count)
+        taken.append((start, used))
+        if used == length:
+            extents.pop(0)
+        else:
+            extents[0] = (start + used, length - used)
+        count -= used
+    return taken
+
+
+def _write_chunk(fs, inode, offset, data):
+    view = memoryview(data)
+    written = 0
+    for position, count in fs._file_segments(inode, offset, len(view)):
+        fs._write_data(position, view[written:written + count])
+        written += count
+
+
+def _copy_in(fs, inode, path, size, data, chunk_size):
+    """Write up to size bytes of a host file into the blocks already mapped by inode."""
+    if data is not None:
+        data = data[:size]
+        _write_chunk(fs, inode, 0, data)
+        return len(data)
+    copied = 0
+    buffer = bytearray(min(chunk_size, size) or 1)
+    with open(path, 'rb', buffering=0) as f:
+        while copied < size:
+            count = f.readinto(memoryview(buffer)[:min(len(buffer), size - copied)])
+            if not count:
+                break
+            _write_chunk(fs, inode, copied, memoryview(buffer)[:count])
+            copied += count
+    return copied
+
+
+def _batch_size(fs):
+    """How many entries one batch may create so its transaction fits the journal, or 0 for no limit."""
+    if fs.journal is None:
+        return 0
+    # Each entry may touch an inode table block, a directory bucket and a
+    # new directory's bucket; keep half the log for the other operations
+    return max(fs.journal.capacity // 6, 1)
+
+
+def _import_batch(fs, dir_inode_number, files, dirs, pool, chunk_size):
+    """Create the files and subdirectories of one host directory in one transaction.
+
+    Inodes and blocks for the whole batch are allocated up front, the file
+    data is written into the blocks in order, and the directory is updated
+    once at the end. Returns ({subdirectory name: inode number}, file
+    count, bytes copied).
+    """
+    block_size = fs.sb.block_size
+    files = [(entry.name, entry.path, entry.stat(follow_symlinks=False).st_size) for entry in files]
+    names = [name for name, _, _ in files] + [entry.name for entry in dirs]
+    for name in names:
+        fs._check_name(name)
+    with fs._operation(), fs.locks.write(dir_inode_number):
+        for name in names:
+            if fs._dir_lookup(dir_inode_number, name) is not None:
+                raise FileExistsError(f"'{name}' already exists.")
+        inode_numbers = []
+        extents = []
+        try:
+            for _ in names:
+                inode_numbers.append(fs._alloc_inode())
+            extents = fs._alloc_extents(sum(-(-size // block_size) for _, _, size in files) + len(dirs))
+            remaining = list(extents)
+            loaded = None
+            if pool is not None:
+                small = [path for _, path, size in files if size <= chunk_size]
+                loaded = pool.map(_read_host_file, small, chunksize=16)
+            entries = []
+            tails = []
+            copied = 0
+            numbers = iter(inode_numbers)
+            for name, path, size in files:
+                inode_number = next(numbers)
+                inode = Inode()
+                inode.parent = dir_inode_number
+                inode.extents = _take_blocks(remaining, -(-size // block_size))
+                data = next(loaded) if loaded is not None and size <= chunk_size else None
+                inode.file_size = _copy_in(fs, inode, path, size, data, chunk_size)
+                if inode.file_size < size:
+                    # The host file shrank since it was listed; its unused
+                    # blocks are given back once the batch is in place.
+                    tail = list(inode.extents)
+                    inode.extents = _take_blocks(tail, -(-inode.file_size // block_size))
+                    tails.extend(tail)
+                copied += inode.file_size
+                fs.write_inode(inode_number, inode)
+                entries.append(DirectoryEntry(name, inode_number))
+            subdirectories = {}
+            for entry in dirs:
+                inode_number = next(numbers)
+                inode = Inode()
+                inode.is_directory = True
+                inode.parent = dir_inode_number
+                inode.extents = _take_blocks(remaining, 1)
+                inode.file_size = block_size
+                fs._write_bucket(inode.extents[0][0], [])
+                fs.write_inode(inode_number, inode)
+                entries.append(DirectoryEntry(entry.name, inode_number, True))
+                subdirectories[entry.name] = inode_number
+            fs._dir_insert_many(dir_inode_number, entries)
+        except BaseException:
+            fs._free_extents(extents)
+            for inode_number in inode_numbers:
+                fs._free_inode(inode_number)
+            raise
+        fs._free_extents(tails)
+    return subdirectories, len(files), copied
+
+
+def import_tree(fs, host_path, vfs_path, processes=0, chunk_size=1 << 20):
+    """Copy the contents of the host directory host_path into vfs_path.
+
+    vfs_path is created if it does not exist. Each host directory is one
+    batch (see _import_batch), or several when it has more entries than
+    one journal transaction can hold, so the tree is loaded with one
+    directory update per batch instead of one per file. With processes > 0,
+    files of up to chunk_size bytes are read by a pool of that many
+    worker processes while the image is being written. Symbolic links
+    and special files are skipped. fs may be a mounted FileSystem or an
+    image path. Returns the number of files, directories and bytes copied.
+    """
+    own = isinstance(fs, str)
+    if own:
+        fs = FileSystem(fs)
+    pool = ProcessPoolExecutor(processes) if processes else None
+    totals = {'files': 0, 'directories': 0, 'bytes': 0}
+    try:
+        fs._check_writable()
+        try:
+            target = fs.resolve(vfs_path, 'Directory')
+        except FileNotFoundError:
+            target = fs.mkdir(vfs_path)
+        if not fs.read_inode(target).is_directory:
+            raise NotADirectoryError(f"'{vfs_path}' is not a directory.")
+        pending = [(host_path, target)]
+        while pending:
+            host_dir, dir_inode_number = pending.pop()
+            with os.scandir(host_dir) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            files = [entry for entry in entries if entry.is_file(follow_symlinks=False)]
+            dirs = [entry for entry in entries if entry.is_dir(follow_symlinks=False)]
+            listed = files + dirs
+            batch = _batch_size(fs) or len(listed) or 1
+            for first in range(0, len(listed), batch):
+                chunk = listed[first:first + batch]
+                split = max(len(files) - first, 0)
+                subdirectories, file_count, copied = _import_batch(
+                    fs, dir_inode_number, chunk[:split], chunk[split:], pool, chunk_size)
+                totals['files'] += file_count
+                totals['directories'] += len(subdirectories)
+                totals['bytes'] += copied
+                pending.extend((os.path.join(host_dir, name), inode_number)
+                               for name, inode_number in subdirectories.items())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if own:
+            fs.close()
+    return totals
+
+
+def export_tree(fs, vfs_path, host_path, chunk_size=1 << 20):
+    """Copy the directory vfs_path and everything below it to host_path.
+
+    Files are copied in the order their data is laid out in the image so
+    the image is read sequentially, chunk_size bytes at a time. fs may be
+    a mounted FileSystem or an image path. Returns the number of files,
+    directories and bytes copied.
+    """
+    own = isinstance(fs, str)
+    if own:
+        fs = FileSystem(fs)
+    totals = {'files': 0, 'directories': 0, 'bytes': 0}
+    try:
+        root = fs.resolve(vfs_path, 'Directory')
+        if not fs.read_inode(root).is_directory:
+            raise NotADirectoryError(f"'{vfs_path}' is not a directory.")
+        os.makedirs(host_path, exist_ok=True)
+        files = []
+        pending = [(root, host_path)]
+        while pending:
+            dir_inode_number, host_dir = pending.pop()
+            for entry in fs._dir_entries(dir_inode_number):
+                target = os.path.join(host_dir, entry.name)
+                if entry.is_directory:
+                    os.makedirs(target, exist_ok=True)
+                    pending.append((entry.inode_number, target))
+                    totals['directories'] += 1
+                else:
+                    files.append((fs.read_inode(entry.inode_number), entry.inode_number, target))
+        files.sort(key=lambda item: item[0].extents[0][0] if item[0].extents else 0)
+        for inode, inode_number, target in files:
+            with open(target, 'wb') as out, fs.locks.read(inode_number):
+                inode = fs.read_inode(inode_number)
+                for offset in range(0, inode.file_size, chunk_size):
+                    for view in fs._read_at(inode, offset, chunk_size):
+                        out.write(view)
+            totals['files'] += 1
+            totals['bytes'] += inode.file_size
+    finally:
+        if own:
+            fs.close()
+    return totals
@@ -1,29 +1,535 @@
+import copy
+import hashlib
+import os
+import re
 import time
-import pickle
+import struct
+import zlib
+
+# On-disk inode: file_size, flags, parent directory inode, creation_time,
+# modification_time, extent count, first overflow extent block and 10
+# inline (start block, block count) extents, padded out to a fixed
+# INODE_SIZE slot.
+INODE_SIZE = 128
+INLINE_EXTENTS = 10
+INODE_STRUCT = struct.Struct('<QIIddII%dI8x' % (INLINE_EXTENTS * 2))
+INODE_FLAG_DIRECTORY = 0x1
+NO_BLOCK = 0  # Block 0 is the superblock, so it never appears as a data pointer
+
+# Extents that do not fit inline live in a chain of extent blocks, each
+# holding a header (extent count, next extent block) and packed extents.
+EXTENT_BLOCK_HEADER = struct.Struct('<II')
+EXTENT = struct.Struct('<II')
+
+# Directories are hash tables: each data block of a directory is one bucket
+# holding a header (entry count, bytes used) followed by packed entries of
+# (inode number, type, name length, name). Bucket count is a power of two.
+DIR_BUCKET_HEADER = struct.Struct('<HH')
+DIR_ENTRY_HEADER = struct.Struct('<IBB')
+DIR_TYPE_FILE = 1
+DIR_TYPE_DIRECTORY = 2
+MAX_NAME_LENGTH = 255
+
+# Superblock, stored at the start of block 0: magic, format version, then
+# the geometry fields in SUPERBLOCK_FIELDS order. Each version appends
+# fields; SUPERBLOCK_FIELD_COUNTS says how many a given version stores.
+SUPERBLOCK_MAGIC = b'PYFS'
+SUPERBLOCK_VERSION = 3
+SUPERBLOCK_FIELDS = ('block_size', 'total_blocks', 'total_inodes', 'root_dir_inode',
+                     'inodes_bitmap_start', 'inodes_bitmap_blocks', 'inode_table_start',
+                     'inode_table_blocks', 'free_space_map_start', 'free_space_map_blocks',
+                     'journal_start', 'journal_blocks', 'data_start',
+                     'refcount_start', 'refcount_blocks', 'dedup_index_start', 'dedup_index_blocks',
+                     'snapshot_table')
+SUPERBLOCK_FIELD_COUNTS = {1: 13, 2: 17, 3: 18}
+SUPERBLOCK_HEADER = struct.Struct('<4sI')
+
+# Deduplication, when the image has the regions for it: a table of one
+# REFCOUNT per block, and a hash index of DEDUP_INDEX_ENTRY slots
+# (content digest, block number) in which a block's digest selects the
+# bucket block. Block number 0 marks a free slot.
+REFCOUNT = struct.Struct('<I')
+DEDUP_INDEX_ENTRY = struct.Struct('<16sI')
+DEDUP_DIGEST_SIZE = 16
+
+# Snapshots: the snapshot_table block holds SNAPSHOT_ENTRY records (name,
+# creation time, first block of the snapshot's copy of the metadata
+# regions); an all-zero record is a free slot. The copy holds the regions
+# of SNAPSHOT_REGIONS back to back, each as long as its live counterpart.
+SNAPSHOT_ENTRY = struct.Struct('<64sdI')
+MAX_SNAPSHOT_NAME = 64
+SNAPSHOT_REGIONS = (('inodes_bitmap_start', 'inodes_bitmap_blocks'),
+                    ('inode_table_start', 'inode_table_blocks'),
+                    ('free_space_map_start', 'free_space_map_blocks'),
+                    ('refcount_start', 'refcount_blocks'),
+                    ('dedup_index_start', 'dedup_index_blocks'))
 
 class Superblock:
+    """Image geometry. The defaults describe the original fixed layout."""
+
     def __init__(self):
         self.block_size = 4096
         self.total_blocks = 1000
         self.inode_table_start = 2  # After inode bitmap (block 1)
-        self.total_inodes = 128
+        self.inode_table_blocks = 4
+        self.total_inodes = 128  # 128 * INODE_SIZE bytes -> blocks 2-5
         self.inodes_bitmap_start = 1  # Block 1 for inode bitmap
+        self.inodes_bitmap_blocks = 1
         self.root_dir_inode = 0
-        self.free_space_map_start = 4  # Block 4 for free space bitmap
+        self.free_space_map_start = 6  # Block 6 for free space bitmap
+        self.free_space_map_blocks = 1  # One bit per block, as many blocks as needed
+        self.journal_start = 7  # Write-ahead journal region after the bitmap
+        self.journal_blocks = 0
+        self.refcount_start = 7  # Dedup regions after the journal, if any
+        self.refcount_blocks = 0
+        self.dedup_index_start = 7
+        self.dedup_index_blocks = 0
+        self.data_start = 7  # First block after the metadata regions
+        self.snapshot_table = 0  # Allocated with the first snapshot
+
+    def pack(self):
+        return SUPERBLOCK_HEADER.pack(SUPERBLOCK_MAGIC, SUPERBLOCK_VERSION) + struct.pack(
+            '<%dQ' % len(SUPERBLOCK_FIELDS), *(getattr(self, name) for name in SUPERBLOCK_FIELDS))
+
+    @classmethod
+    def unpack(cls, data):
+        """Decode a superblock; images from before the binary format are rejected."""
+        sb = cls()
+        if data[:4] == SUPERBLOCK_MAGIC:
+            _, version = SUPERBLOCK_HEADER.unpack_from(data)
+            count = SUPERBLOCK_FIELD_COUNTS.get(version)
+            if count is None:
+                raise OSError(f"Unsupported filesystem version {version}.")
+            fields = struct.unpack_from('<%dQ' % count, data, SUPERBLOCK_HEADER.size)
+            sb.__dict__.update(zip(SUPERBLOCK_FIELDS, fields))
+        elif data[:1] == b'\x80':
+            # The pickle protocol marker that opened the old superblock
+            raise OSError("Unsupported (pre-binary) image format.")
+        else:
+            raise OSError("Not a filesystem image.")
+        return sb
+
+def read_superblock(fd):
+    # Superblock fields fit well inside the smallest supported block
+    return Superblock.unpack(os.pread(fd, 4096, 0))
+
+class Snapshot:
+    """One entry of the snapshot table."""
+
+    def __init__(self, name, created, start):
+        self.name = name
+        self.created = created
+        self.start = start  # First block of the copied metadata regions
+
+    def __repr__(self):
+        return f"Snapshot({self.name!r}, created={time.ctime(self.created)})"
+
+    def superblock(self, sb):
+        """The superblock of the image as it was when the snapshot was taken."""
+        frozen = copy.copy(sb)
+        block_num = self.start
+        for start_field, blocks_field in SNAPSHOT_REGIONS:
+            setattr(frozen, start_field, block_num)
+            block_num += getattr(sb, blocks_field)
+        return frozen
+
+def snapshot_blocks(sb):
+    """Number of blocks one snapshot's copy of the metadata regions takes."""
+    return sum(getattr(sb, blocks_field) for _, blocks_field in SNAPSHOT_REGIONS)
+
+def pack_snapshot_table(snapshots, block_size):
+    data = b''.join(SNAPSHOT_ENTRY.pack(s.name.encode('utf-8'), s.created, s.start) for s in snapshots)
+    return data.ljust(block_size, b'\x00')
+
+def unpack_snapshot_table(data):
+    usable = len(data) - len(data) % SNAPSHOT_ENTRY.size
+    return [Snapshot(name.rstrip(b'\x00').decode('utf-8'), created, start)
+            for name, created, start in SNAPSHOT_ENTRY.iter_unpack(data[:usable]) if start]
+
+def read_snapshots(fd, sb):
+    if not sb.snapshot_table:
+        return []
+    return unpack_snapshot_table(os.pread(fd, sb.block_size, sb.snapshot_table * sb.block_size))
+
+class Bitmap:
+    """Bit-packed allocation map; bit i set means item i is in use.
+
+    Bits are stored least significant first within each byte. Padding bits
+    past size are kept set so searches never return them. Allocation is
+    next-fit: searches start at the position after the last allocation and
+    wrap around once. Modified chunk_size-byte chunks are remembered so
+    only those need writing back (see take_dirty()).
+    """
+
+    _NOT_FULL = re.compile(b'[^\xff]')
+    _NOT_FULL_SPANS = re.compile(b'[^\xff]+')
+    _NOT_EMPTY = re.compile(b'[^\x00]')
+
+    def __init__(self, size, data=None, chunk_size=4096):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.bits = bytearray((size + 7) // 8)
+        self.dirty = set()
+        if data is not None:
+            self.load(data)
+            self.dirty.clear()
+        elif size % 8:
+            self.bits[-1] |= 0xFF << (size % 8) & 0xFF
+        self.free = len(self.bits) * 8 - int.from_bytes(self.bits, 'little').bit_count()
+        self.hint = 0
+
+    def load(self, data):
+        """Replace every bit with those in data, marking all chunks modified."""
+        nbytes = len(self.bits)
+        self.bits[:] = bytes(data[:nbytes]).ljust(nbytes, b'\x00')
+        if self.size % 8:
+            self.bits[-1] |= 0xFF << (self.size % 8) & 0xFF
+        self.free = nbytes * 8 - int.from_bytes(self.bits, 'little').bit_count()
+        self.dirty.update(range(-(-nbytes // self.chunk_size)))
+
+    def __len__(self):
+        return self.size
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+    def take_dirty(self):
+        """Return (byte offset, bytes) for every modified chunk and forget them."""
+        chunks = [(chunk * self.chunk_size,
+                   bytes(self.bits[chunk * self.chunk_size:(chunk + 1) * self.chunk_size]))
+                  for chunk in sorted(self.dirty)]
+        self.dirty.clear()
+        return chunks
+
+    def set_indices(self):
+        """Yield the index of every set bit below size."""
+        for match in self._NOT_EMPTY.finditer(self.bits):
+            byte = self.bits[match.start()]
+            for bit in range(8):
+                index = match.start() * 8 + bit
+                if byte >> bit & 1 and index < self.size:
+                    yield index
+
+    def is_set(self, index):
+        return bool(self.bits[index >> 3] >> (index & 7) & 1)
+
+    def set(self, index):
+        mask = 1 << (index & 7)
+        if not self.bits[index >> 3] & mask:
+            self.bits[index >> 3] |= mask
+            self.free -= 1
+            self.dirty.add((index >> 3) // self.chunk_size)
+
+    def clear(self, index):
+        mask = 1 << (index & 7)
+        if self.bits[index >> 3] & mask:
+            self.bits[index >> 3] &= ~mask
+            self.free += 1
+            self.dirty.add((index >> 3) // self.chunk_size)
+
+    def _used_in(self, first_byte, end_byte):
+        return int.from_bytes(self.bits[first_byte:end_byte], 'little').bit_count()
+
+    def _fill(self, start, count, value):
+        end = start + count
+        first_byte, last_byte = start >> 3, (end - 1) >> 3
+        before = self._used_in(first_byte, last_byte + 1)
+        if first_byte == last_byte:
+            mask = ((1 << count) - 1) << (start & 7)
+            self.bits[first_byte] = self.bits[first_byte] | mask if value else self.bits[first_byte] & ~mask
+        else:
+            head = (0xFF << (start & 7)) & 0xFF
+            tail = 0xFF >> (7 - ((end - 1) & 7))
+            self.bits[first_byte] = self.bits[first_byte] | head if value else self.bits[first_byte] & ~head
+            self.bits[last_byte] = self.bits[last_byte] | tail if value else self.bits[last_byte] & ~tail
+            self.bits[first_byte + 1:last_byte] = (b'\xff' if value else b'\x00') * (last_byte - first_byte - 1)
+        self.free -= self._used_in(first_byte, last_byte + 1) - before
+        self.dirty.update(range(first_byte // self.chunk_size, last_byte // self.chunk_size + 1))
+
+    def set_range(self, start, count):
+        if count > 0:
+            self._fill(start, count, True)
+
+    def clear_range(self, start, count):
+        if count > 0:
+            self._fill(start, count, False)
+
+    def find_free(self):
+        """Return the next free index at or after the hint, wrapping once, or -1."""
+        for lo, hi in ((self.hint >> 3, len(self.bits)), (0, len(self.bits))):
+            match = self._NOT_FULL.search(self.bits, lo, hi)
+            if match:
+                k = match.start()
+                byte = self.bits[k]
+                return k * 8 + ((~byte & (byte + 1)).bit_length() - 1)
+        return -1
+
+    def find_run(self, count):
+        """Return the start of a free run of count items, or -1.
+
+        Long runs are located by searching for whole zero bytes at C speed
+        and widening the match with the LOW_FREE/HIGH_FREE byte tables;
+        short runs walk the non-full bytes with the same tables.
+        """
+        if count <= 0:
+            return self.hint
+        if count > self.free:
+            return -1
+        if count == 1:
+            return self.find_free()
+        hint_byte = min(self.hint >> 3, len(self.bits))
+        search = self._find_long_run if count >= 15 else self._find_short_run
+        for lo, hi in ((hint_byte, len(self.bits)), (0, len(self.bits))):
+            start = search(count, lo, hi)
+            if start >= 0:
+                return start
+        return -1
+
+    def _find_long_run(self, count, lo, hi):
+        bits = self.bits
+        pattern = b'\x00' * ((count + 1) // 8 - 1)
+        pos = lo
+        while pos < hi:
+            k = bits.find(pattern, pos, hi)
+            if k < 0:
+                return -1
+            match = self._NOT_EMPTY.search(bits, k + len(pattern), hi)
+            end = match.start() if match else hi
+            head = HIGH_FREE[bits[k - 1]] if k > lo else 0
+            tail = LOW_FREE[bits[end]] if end < hi else 0
+            if head + (end - k) * 8 + tail >= count:
+                return k * 8 - head
+            pos = end + 1
+        return -1
+
+    def _find_short_run(self, count, lo, hi):
+        bits = self.bits
+        for span in self._NOT_FULL_SPANS.finditer(bits, lo, hi):
+            run = 0
+            run_start = 0
+            for k in range(span.start(), span.end()):
+                byte = bits[k]
+                if byte == 0:
+                    if run == 0:
+                        run_start = k * 8
+                    run += 8
+                    if run >= count:
+                        return run_start
+                    continue
+                if run + LOW_FREE[byte] >= count:
+                    return run_start if run else k * 8
+                if MAX_FREE[byte] >= count:
+                    return k * 8 + _first_free_run_in_byte(byte, count)
+                run = HIGH_FREE[byte]
+                run_start = k * 8 + 8 - run
+        return -1
+
+    def free_run_at(self, start, limit):
+        """Return how many items from start on are free, up to limit."""
+        end = min(start + limit, self.size)
+        index = start
+        while index < end and index & 7:
+            if self.is_set(index):
+                return index - start
+            index += 1
+        if index < end:
+            match = self._NOT_EMPTY.search(self.bits, index >> 3, (end + 7) >> 3)
+            if match is None:
+                return end - start
+            index = match.start() * 8 + LOW_FREE[self.bits[match.start()]]
+        return min(index, end) - start
+
+    def allocate(self, count=1):
+        """Claim a contiguous run of count items and return its start, or -1."""
+        start = self.find_run(count)
+        if start >= 0:
+            self.set_range(start, count)
+            self.hint = start + count
+        return start
+
+def _free_bits(byte):
+    return [not byte >> bit & 1 for bit in range(8)]
+
+def _longest_run(flags):
+    best = run = 0
+    for flag in flags:
+        run = run + 1 if flag else 0
+        best = max(best, run)
+    return best
+
+def _first_free_run_in_byte(byte, count):
+    run = 0
+    for bit in range(8):
+        run = run + 1 if not byte >> bit & 1 else 0
+        if run >= count:
+            return bit - count + 1
+    return -1
+
+# Per-byte tables: free bits at the low end, at the high end and the
+# longest free run anywhere in the byte.
+LOW_FREE = bytes(_longest_run(_free_bits(b)[:next((i for i in range(8) if b >> i & 1), 8)])
+                 for b in range(256))
+HIGH_FREE = bytes(_longest_run(_free_bits(b)[next((i for i in range(7, -1, -1) if b >> i & 1), -1) + 1:])
+                  for b in range(256))
+MAX_FREE = bytes(_longest_run(_free_bits(b)) for b in range(256))
 
 class Inode:
+    __slots__ = ('file_size', 'is_directory', 'parent', 'creation_time',
+                 'modification_time', 'extents', 'extent_count', 'extent_block')
+
     def __init__(self):
         self.file_size = 0
         self.is_directory = False
+        self.parent = 0  # Directory containing this inode; root is its own parent
         self.creation_time = time.time()
         self.modification_time = time.time()
-        self.direct_blocks = [None] * 10  # Space for 10 direct block pointers
+        self.extents = []  # (first block, block count) runs in file order
+        self.extent_count = 0  # Total extents on disk, including overflow ones
+        self.extent_block = None  # Head of the overflow extent chain
+
+    def blocks(self):
+        for start, length in self.extents:
+            yield from range(start, start + length)
+
+    def block_count(self):
+        return sum(length for _, length in self.extents)
+
+    def pack(self):
+        flags = INODE_FLAG_DIRECTORY if self.is_directory else 0
+        inline = [0] * (INLINE_EXTENTS * 2)
+        for i, (start, length) in enumerate(self.extents[:INLINE_EXTENTS]):
+            inline[i * 2] = start
+            inline[i * 2 + 1] = length
+        extent_block = NO_BLOCK if self.extent_block is None else self.extent_block
+        return INODE_STRUCT.pack(self.file_size, flags, self.parent, self.creation_time,
+                                 self.modification_time, len(self.extents), extent_block,
+                                 *inline)
+
+    @classmethod
+    def from_fields(cls, fields):
+        """Build an inode from unpacked fields.
+
+        Only the inline extents are filled in; when extent_count exceeds
+        INLINE_EXTENTS the caller has to load the rest from extent_block.
+        """
+        inode = cls.__new__(cls)
+        inode.file_size = fields[0]
+        inode.is_directory = bool(fields[1] & INODE_FLAG_DIRECTORY)
+        inode.parent = fields[2]
+        inode.creation_time = fields[3]
+        inode.modification_time = fields[4]
+        inode.extent_count = fields[5]
+        inode.extent_block = None if fields[6] == NO_BLOCK else fields[6]
+        inline = min(inode.extent_count, INLINE_EXTENTS)
+        inode.extents = [(fields[7 + i * 2], fields[8 + i * 2]) for i in range(inline)]
+        return inode
+
+    @classmethod
+    def unpack(cls, data, offset=0):
+        return cls.from_fields(INODE_STRUCT.unpack_from(data, offset))
+
+    @classmethod
+    def unpack_table(cls, data):
+        """Decode a run of consecutive inode slots in a single pass."""
+        usable = len(data) - len(data) % INODE_SIZE
+        return [cls.from_fields(f) for f in INODE_STRUCT.iter_unpack(data[:usable])]
+
+def extents_from_blocks(blocks):
+    """Collapse a list of block numbers into (start, length) runs."""
+    extents = []
+    for block in blocks:
+        if extents and extents[-1][0] + extents[-1][1] == block:
+            extents[-1] = (extents[-1][0], extents[-1][1] + 1)
+        else:
+            extents.append((block, 1))
+    return extents
+
+def pack_extent_block(extents, next_block):
+    return EXTENT_BLOCK_HEADER.pack(len(extents), next_block or NO_BLOCK) + \
+        b''.join(EXTENT.pack(start, length) for start, length in extents)
+
+def unpack_extent_block(data):
+    """Return (extents, next extent block or None) for one chain block."""
+    count, next_block = EXTENT_BLOCK_HEADER.unpack_from(data, 0)
+    extents = list(EXTENT.iter_unpack(data[EXTENT_BLOCK_HEADER.size:
+                                           EXTENT_BLOCK_HEADER.size + count * EXTENT.size]))
+    return extents, (None if next_block == NO_BLOCK else next_block)
 
 class DirectoryEntry:
-    def __init__(self, name, inode_num):
+    __slots__ = ('name', 'inode_number', 'is_directory')
+
+    def __init__(self, name, inode_num, is_directory=False):
         self.name = name
         self.inode_number = inode_num
-        self.directory_size = 0  # Placeholder for directory size
+        self.is_directory = is_directory
+
+    def packed_size(self):
+        return DIR_ENTRY_HEADER.size + len(self.name.encode('utf-8'))
+
+class ScanEntry:
+    """Entry yielded by FileSystem.scandir() and walk().
+
+    name, path, inode number and type come from the directory entry itself,
+    so listing a directory reads no inodes; stat() decodes the entry's
+    inode on first use and caches it.
+    """
+    __slots__ = ('fs', 'name', 'path', 'inode_number', 'is_directory', '_inode')
+
+    def __init__(self, fs, dir_path, entry):
+        self.fs = fs
+        self.name = entry.name
+        self.path = dir_path.rstrip('/') + '/' + entry.name if dir_path else entry.name
+        self.inode_number = entry.inode_number
+        self.is_directory = entry.is_directory
+        self._inode = None
+
+    def __repr__(self):
+        return f"<ScanEntry '{self.path}' inode {self.inode_number}>"
+
+    def is_dir(self):
+        return self.is_directory
+
+    def is_file(self):
+        return not self.is_directory
+
+    def stat(self):
+        """The entry's inode (inline extents only, see FileSystem.peek_inode())."""
+        if self._inode is None:
+            self._inode = self.fs.peek_inode(self.inode_number)
+        return self._inode
+
+def directory_hash(name):
+    # crc32 rather than hash() so bucket placement is stable across processes
+    return zlib.crc32(name.encode('utf-8'))
+
+def block_digest(data):
+    """Content digest under which a data block is kept in the dedup index."""
+    return hashlib.blake2b(data, digest_size=DEDUP_DIGEST_SIZE).digest()
+
+def pack_directory_bucket(entries, block_size):
+    parts = []
+    used = DIR_BUCKET_HEADER.size
+    for entry in entries:
+        name = entry.name.encode('utf-8')
+        file_type = DIR_TYPE_DIRECTORY if entry.is_directory else DIR_TYPE_FILE
+        parts.append(DIR_ENTRY_HEADER.pack(entry.inode_number, file_type, len(name)))
+        parts.append(name)
+        used += DIR_ENTRY_HEADER.size + len(name)
+    if used > block_size:
+        raise OSError("Directory bucket overflow.")
+    return DIR_BUCKET_HEADER.pack(len(entries), used) + b''.join(parts)
+
+def unpack_directory_bucket(data):
+    count, _ = DIR_BUCKET_HEADER.unpack_from(data, 0)
+    entries = []
+    offset = DIR_BUCKET_HEADER.size
+    for _ in range(count):
+        inode_number, file_type, name_length = DIR_ENTRY_HEADER.unpack_from(data, offset)
+        offset += DIR_ENTRY_HEADER.size
+        name = bytes(data[offset:offset + name_length]).decode('utf-8')
+        offset += name_length
+        entries.append(DirectoryEntry(name, inode_number, file_type == DIR_TYPE_DIRECTORY))
+    return entries
 
 class FileEntry:
     def __init__(self, name, inode_num):
@@ -32,33 +538,181 @@ class FileEntry:
         self.file_size = 0  # Placeholder for file size
 
 class FileObject:
-    def __init__(self, fs_image, inode_number, mode='r'):
-        self.fs_image = fs_image
+    """File-like handle on one inode of a mounted FileSystem.
+
+    Supports read, readinto, write, seek, tell, truncate and flush, and
+    iterates over the contents in chunks. Blocks are allocated as writes
+    extend the file, so payloads can be streamed through with bounded
+    memory. Modes follow open(): 'r', 'w', 'a', 'x', each optionally with
+    '+'; data is always bytes, and str passed to write() is UTF-8 encoded.
+    fs may be a mounted FileSystem or an image path, in which case the
+    handle mounts the image itself and unmounts it on close().
+    Each call holds the inode's lock for its duration, shared for reads and
+    exclusive for writes, and picks up changes made through other handles
+    unless this one has unflushed changes of its own.
+    """
+
+    def __init__(self, fs, inode_number, mode='r', close_fs=False):
+        if isinstance(fs, str):
+            from FileOperations import FileSystem
+            fs = FileSystem(fs)
+            close_fs = True
+        self.fs = fs
+        self.fs_image = fs.fs_image
         self.inode_number = inode_number
         self.mode = mode
-        self.fs = open(fs_image, 'r+b' if 'w' in mode or 'a' in mode else 'rb')
-        from FileOperations import read_inode
-        self.inode = read_inode(self.fs, inode_number)
-        self.offset = 0
+        self.close_fs = close_fs
+        self.inode = fs.read_inode(inode_number)
+        self.offset = self.inode.file_size if 'a' in mode else 0
+        self.closed = False
+        self._dirty = False
 
-def open_file(fs_image, filename, mode='r', cwd_inode_number=0):
-    from FileOperations import read_inode
-    sp = Superblock()
-    with open(fs_image, 'rb') as fs:
-        current_inode = read_inode(fs, cwd_inode_number)
-        dir_block = current_inode.direct_blocks[0]
-        if dir_block is None:
-            print("Directory is empty.")
-            return None
-        dir_offset = dir_block * sp.block_size
-        fs.seek(dir_offset)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __iter__(self):
+        return self.chunks()
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+
+    def readable(self):
+        return 'r' in self.mode or '+' in self.mode
+
+    def writable(self):
+        return any(c in self.mode for c in 'wax+')
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        self._check_open()
+        if not self.readable():
+            raise OSError("File not open for reading.")
+        with self.fs.locks.read(self.inode_number):
+            self._refresh()
+            if size is None or size < 0:
+                size = max(0, self.inode.file_size - self.offset)
+            data = b''.join(self.fs._read_at(self.inode, self.offset, size))
+        self.offset += len(data)
+        return data
+
+    def readinto(self, buffer):
+        self._check_open()
+        if not self.readable():
+            raise OSError("File not open for reading.")
+        target = memoryview(buffer).cast('B')
+        filled = 0
+        with self.fs.locks.read(self.inode_number):
+            self._refresh()
+            for view in self.fs._read_at(self.inode, self.offset, len(target)):
+                target[filled:filled + len(view)] = view
+                filled += len(view)
+        self.offset += filled
+        return filled
+
+    def chunks(self, size=None):
+        """Yield the rest of the file in pieces of at most size bytes."""
+        size = size or self.fs.sb.block_size * 16
+        while True:
+            data = self.read(size)
+            if not data:
+                return
+            yield data
+
+    def write(self, data):
+        self._check_open()
+        if not self.writable():
+            raise OSError("File not open for writing.")
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self.fs._operation(), self.fs.locks.write(self.inode_number):
+            self._refresh()
+            if 'a' in self.mode:
+                self.offset = self.inode.file_size
+            self.fs._write_at(self.inode, self.offset, data)
+            self._dirty = True
+            self._log_inode()
+        self.offset += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        self._check_open()
+        if whence == 0:
+            position = offset
+        elif whence == 1:
+            position = self.offset + offset
+        elif whence == 2:
+            position = self.inode.file_size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence}).")
+        if position < 0:
+            raise ValueError("Negative seek position.")
+        self.offset = position
+        return self.offset
+
+    def tell(self):
+        self._check_open()
+        return self.offset
+
+    def truncate(self, size=None):
+        self._check_open()
+        if not self.writable():
+            raise OSError("File not open for writing.")
+        size = self.offset if size is None else size
+        if size < 0:
+            raise ValueError(f"Negative size ({size}).")
+        with self.fs._operation(), self.fs.locks.write(self.inode_number):
+            self._refresh()
+            self.fs._resize(self.inode, size)
+            self._dirty = True
+            self._log_inode()
+        return size
+
+    def _refresh(self):
+        if not self._dirty:
+            self.inode = self.fs.read_inode(self.inode_number)
+
+    def _log_inode(self):
+        # With a journal the inode goes into the same transaction as the
+        # blocks just allocated or freed for it.
+        if self.fs.journal is not None:
+            self.flush()
+
+    def flush(self):
+        """Write the inode back to the mounted filesystem; FileSystem.sync() makes it durable."""
+        self._check_open()
+        if self._dirty:
+            with self.fs._operation(), self.fs.locks.write(self.inode_number):
+                self.fs.write_inode(self.inode_number, self.inode)
+            self._dirty = False
+
+    def close(self):
+        if self.closed:
+            return
         try:
-            dir_entries = pickle.load(fs)
-        except Exception:
-            print("Failed to read directory entries.")
-            return None
-        for entry in dir_entries:
-            if entry.name == filename:
-                return FileObject(fs_image, entry.inode_number, mode)
-        print(f"File '{filename}' not found.")
-        return None
\ No newline at end of file
+            self.flush()
+        finally:
+            self.closed = True
+            if self.close_fs:
+                self.fs.close()
+
+def open_file(fs_image, filename, mode='r', cwd_inode_number=0):
+    from FileOperations import FileSystem
+    try:
+        fs = FileSystem(fs_image, cwd_inode_number)
+    except OSError as e:
+        print(e)
+        return None
+    try:
+        file_object = fs.open(filename, mode)
+    except OSError as e:
+        fs.close()
+        print(e)
+        return None
+    file_object.close_fs = True
+    return file_object
@@ -1,381 +1,1321 @@
-from DataStrucures import Superblock, Inode, DirectoryEntry
-import pickle
+from DataStrucures import (Bitmap, Inode, DirectoryEntry, FileObject, ScanEntry, INODE_SIZE, INLINE_EXTENTS,
+                           DIR_BUCKET_HEADER, EXTENT, EXTENT_BLOCK_HEADER, MAX_NAME_LENGTH,
+                           DEDUP_DIGEST_SIZE, DEDUP_INDEX_ENTRY, REFCOUNT, MAX_SNAPSHOT_NAME, SNAPSHOT_ENTRY,
+                           SNAPSHOT_REGIONS, Snapshot, block_digest, directory_hash, extents_from_blocks,
+                           pack_directory_bucket, pack_extent_block, pack_snapshot_table, read_superblock,
+                           snapshot_blocks, unpack_directory_bucket, unpack_extent_block, unpack_snapshot_table)
+from BlockCache import BlockCache, MappedImage
+from Journal import Journal, replay_journal
+from Locking import InodeLocks, RWLock
+from collections import OrderedDict
+from contextlib import contextmanager
+import functools
+import threading
 import time
 
-sp = Superblock()
-INODE_SIZE = 256  # Adjust if needed
+_MISSING = object()
 
-def read_inode_bitmap(fs):
-    inode_bitmap_offset = sp.inodes_bitmap_start * sp.block_size
-    fs.seek(inode_bitmap_offset)
-    return bytearray(fs.read(sp.total_inodes))
+# Regions are copied to and from snapshots this many blocks at a time
+COPY_CHUNK_BLOCKS = 256
 
-def write_inode_bitmap(fs, bitmap):
-    inode_bitmap_offset = sp.inodes_bitmap_start * sp.block_size
-    fs.seek(inode_bitmap_offset)
-    fs.write(bitmap)
+def _transaction(method):
+    """Run a FileSystem method as one metadata transaction."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._operation():
+            return method(self, *args, **kwargs)
+    return wrapper
 
-def read_inode(fs, index):
-    inode_offset = sp.inode_table_start * sp.block_size + index * INODE_SIZE
-    fs.seek(inode_offset)
-    return pickle.load(fs)
+def _reverse_bits(value, bits):
+    return int(format(value, f'0{bits}b')[::-1], 2) if bits else 0
 
-def write_inode(fs, index, inode):
-    inode_offset = sp.inode_table_start * sp.block_size + index * INODE_SIZE
-    fs.seek(inode_offset)
-    fs.write(pickle.dumps(inode))
+class DentryCache:
+    """Bounded LRU cache of directory lookups keyed on (parent inode, name).
 
-def read_block_bitmap(fs):
-    bitmap_offset = sp.free_space_map_start * sp.block_size
-    fs.seek(bitmap_offset)
-    return bytearray(fs.read(sp.block_size))
+    A cached value of None records that the name is known to be absent.
+    """
 
-def write_block_bitmap(fs, bitmap):
-    bitmap_offset = sp.free_space_map_start * sp.block_size
-    fs.seek(bitmap_offset)
-    fs.write(bitmap)
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
 
-def createFile(fs_image, filename, content):
-    with open(fs_image, 'r+b') as fs:
-        block_bitmap = read_block_bitmap(fs)
-        root_inode = read_inode(fs, 0)
-        root_dir_block = root_inode.direct_blocks[0]
-        if root_dir_block is None:
-            print("Root directory is empty.")
+    def get(self, parent, name):
+        with self.lock:
+            entry = self.entries.get((parent, name), _MISSING)
+            if entry is not _MISSING:
+                self.entries.move_to_end((parent, name))
+            return entry
+
+    def put(self, parent, name, entry):
+        with self.lock:
+            self.entries[(parent, name)] = entry
+            self.entries.move_to_end((parent, name))
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, parent, name):
+        with self.lock:
+            self.entries.pop((parent, name), None)
+
+    def invalidate_directory(self, parent):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == parent]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class FileSystem:
+    """A mounted filesystem image.
+
+    The image is opened once and the superblock and both bitmaps are kept
+    in memory for the lifetime of the mount. All block I/O goes through a
+    write-back BlockCache of cache_blocks blocks; nothing reaches the image
+    until sync() or close(). With use_mmap=True the image is memory-mapped
+    instead and read_bytes() can hand out views without copying.
+    Paths may be absolute or relative to the current directory and are
+    resolved through a DentryCache of dentry_cache_size entries.
+
+    When the image has a journal region and journal=True, metadata blocks
+    (bitmaps, inodes, directories, extent blocks) are logged through a
+    Journal: each operation's updates join the running transaction, and
+    group_commit operations are committed together with one round of
+    fsyncs. File data is written in place and flushed before the metadata
+    that refers to it, and blocks freed by a transaction are not reused
+    until it has committed. A transaction left committed but not
+    checkpointed by a crash is replayed at mount.
+
+    A mounted FileSystem may be shared between threads. Each inode has a
+    reader/writer lock: reads of a file or directory lookups take it
+    shared, anything that changes the inode or its blocks takes it
+    exclusively. The inode and block bitmaps each have their own
+    allocator lock, and commits wait for operations in flight to finish.
+    Operations raise OSError subclasses; the module-level functions below
+    wrap them and print.
+
+    Images created with dedup=True store identical data blocks once: each
+    block written is looked up by content digest in an on-disk hash index,
+    a match becomes another reference to the stored block, and blocks are
+    only freed when their last reference goes. Indexed blocks are never
+    changed in place; a write to one is copied to a new block.
+
+    snapshot() records the state of the filesystem under a name, which
+    can later be mounted read-only with snapshot=name or restored with
+    rollback(); see the Snapshots section below.
+    """
+
+    def __init__(self, fs_image, cwd_inode_number=0, cache_blocks=256, use_mmap=False,
+                 dentry_cache_size=4096, journal=True, group_commit=32, snapshot=None):
+        self.fs_image = fs_image
+        self.fs = open(fs_image, 'r+b')
+        self.sb = read_superblock(self.fs.fileno())
+        if replay_journal(self.fs.fileno(), self.sb.journal_start, self.sb.journal_blocks, self.sb.block_size):
+            # The replayed transaction may have changed the superblock itself
+            self.sb = read_superblock(self.fs.fileno())
+        if use_mmap:
+            self.cache = MappedImage(self.fs, self.sb.block_size,
+                                     self.sb.total_blocks * self.sb.block_size)
+        else:
+            self.cache = BlockCache(self.fs, self.sb.block_size, cache_blocks)
+        self.read_only = snapshot is not None
+        self.journal = None
+        if journal and self.sb.journal_blocks and not self.read_only:
+            self.journal = Journal(self.cache, self.fs.fileno(), self.sb.journal_start,
+                                   self.sb.journal_blocks, self.sb.block_size, group_commit)
+        if snapshot is not None:
+            # From here on the metadata regions are the snapshot's copies
+            self.sb = self._find_snapshot(snapshot).superblock(self.sb)
+        self.locks = InodeLocks()
+        self.inode_alloc_lock = threading.Lock()
+        self.block_alloc_lock = threading.Lock()
+        self.freed = []  # Extents freed by the running transaction
+        self.rename_lock = threading.Lock()
+        self.transaction_lock = RWLock()
+        self._local = threading.local()
+        self.cwd = cwd_inode_number
+        self.inode_bitmap = Bitmap(self.sb.total_inodes, self._read(
+            self.sb.inodes_bitmap_start * self.sb.block_size, (self.sb.total_inodes + 7) // 8),
+            self.sb.block_size)
+        self.block_bitmap = Bitmap(self.sb.total_blocks, self._read(
+            self.sb.free_space_map_start * self.sb.block_size, (self.sb.total_blocks + 7) // 8),
+            self.sb.block_size)
+        self.dentries = DentryCache(dentry_cache_size)
+        self.dedup = self.sb.dedup_index_blocks > 0 and not self.read_only
+        self.dedup_lock = threading.RLock()  # Taken before the block allocator lock
+        self.held = None if self.read_only else self._held_blocks()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self.fs.closed:
             return
-        dir_offset = root_dir_block * sp.block_size
-        fs.seek(dir_offset)
+        self.sync()
+        self.cache.close()
+        self.fs.close()
+
+    def sync(self):
+        # Wait for operations in flight so no half-done one is committed
+        with self.transaction_lock.write_locked():
+            if self.journal is not None:
+                self._commit()
+            else:
+                self._flush_bitmaps()
+                self.cache.sync()
+
+    def _commit(self):
+        # Called with no operation in flight. The blocks freed by the
+        # running transaction go back to the allocator in the same commit
+        # as the metadata that stopped using them; before that, file data
+        # written to them could land over a block the image still uses.
+        with self.block_alloc_lock:
+            for start, length in self.freed:
+                self.block_bitmap.clear_range(start, length)
+            self.freed = []
+        self._flush_bitmaps()
+        self.journal.commit()
+
+    def _freeing_space(self):
+        """Whether more blocks are waiting for the commit than are free."""
+        with self.block_alloc_lock:
+            return sum(length for _, length in self.freed) > self.block_bitmap.free
+
+    def _flush_bitmaps(self):
+        # Only the bitmap blocks touched since the last flush are written
+        with self.inode_alloc_lock:
+            chunks = self.inode_bitmap.take_dirty()
+        for offset, chunk in chunks:
+            self._write(self.sb.inodes_bitmap_start * self.sb.block_size + offset, chunk)
+        with self.block_alloc_lock:
+            chunks = self.block_bitmap.take_dirty()
+        for offset, chunk in chunks:
+            self._write(self.sb.free_space_map_start * self.sb.block_size + offset, chunk)
+
+    @contextmanager
+    def _operation(self):
+        """Group the metadata updates of one operation into a transaction.
+
+        Operations nest; the outermost one writes the changed bitmap blocks
+        and hands the transaction to the journal for group commit. Any
+        number of threads may be inside operations at once.
+        """
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        commit = False
+        self.transaction_lock.acquire_read()
         try:
-            dir_entries = pickle.load(fs)
-        except Exception:
-            dir_entries = []
-        for entry in dir_entries:
-            if entry.name == filename:
-                print(f"File '{filename}' already exists.")
+            yield
+        finally:
+            try:
+                if not depth:
+                    self._flush_bitmaps()
+                    commit = self.journal is not None and (self.journal.operation_done()
+                                                           or self._freeing_space())
+            finally:
+                self.transaction_lock.release_read()
+                self._local.depth = depth
+        if commit:
+            with self.transaction_lock.write_locked():
+                if self.journal.commit_due() or self._freeing_space():
+                    self._commit()
+
+    # Raw image access
+
+    def _read(self, offset, size):
+        if self.journal is not None:
+            return self.journal.read(offset, size)
+        return self.cache.read(offset, size)
+
+    def _write(self, offset, data):
+        if self.journal is not None:
+            self.journal.write(offset, data)
+        else:
+            self.cache.write(offset, data)
+
+    def _write_data(self, offset, data):
+        """Write file contents, which are never journaled."""
+        self.cache.write(offset, data)
+
+    # Inodes
+
+    def read_inode(self, index):
+        offset = self.sb.inode_table_start * self.sb.block_size + index * INODE_SIZE
+        inode = Inode.unpack(self._read(offset, INODE_SIZE))
+        for _, extents in self._extent_chain(inode.extent_block):
+            inode.extents.extend(extents)
+        return inode
+
+    def write_inode(self, index, inode):
+        # Extents beyond the inline ones go to the inode's chain of extent
+        # blocks, which grows or shrinks to fit.
+        overflow = inode.extents[INLINE_EXTENTS:]
+        per_block = (self.sb.block_size - EXTENT_BLOCK_HEADER.size) // EXTENT.size
+        needed = -(-len(overflow) // per_block)
+        chain = [block for block, _ in self._extent_chain(inode.extent_block)]
+        if any(self._is_held(block) for block in chain):
+            # A snapshot still uses the old chain, so build a new one
+            self._free_blocks(chain)
+            chain = []
+        if needed > len(chain):
+            chain += self._alloc_blocks(needed - len(chain))
+        elif needed < len(chain):
+            self._free_blocks(chain[needed:])
+            del chain[needed:]
+        for i, block_num in enumerate(chain):
+            next_block = chain[i + 1] if i + 1 < len(chain) else None
+            self._write(block_num * self.sb.block_size,
+                        pack_extent_block(overflow[i * per_block:(i + 1) * per_block], next_block))
+        inode.extent_block = chain[0] if chain else None
+        offset = self.sb.inode_table_start * self.sb.block_size + index * INODE_SIZE
+        self._write(offset, inode.pack())
+
+    def _extent_chain(self, block_num):
+        """Yield (block number, extents) for each block of an extent chain."""
+        while block_num is not None:
+            extents, next_block = unpack_extent_block(
+                self._read(block_num * self.sb.block_size, self.sb.block_size))
+            yield block_num, extents
+            block_num = next_block
+
+    def peek_inode(self, index):
+        """Decode an inode without following its extent chain."""
+        offset = self.sb.inode_table_start * self.sb.block_size + index * INODE_SIZE
+        return Inode.unpack(self._read(offset, INODE_SIZE))
+
+    def read_inode_table(self):
+        """Decode every inode with one read.
+
+        Only inline extents are populated; use read_inode() when the full
+        block map of a heavily fragmented file is needed.
+        """
+        return Inode.unpack_table(self._read(self.sb.inode_table_start * self.sb.block_size,
+                                             self.sb.total_inodes * INODE_SIZE))
+
+    # Allocation
+
+    def _alloc_inode(self):
+        with self.inode_alloc_lock:
+            index = self.inode_bitmap.allocate()
+        if index < 0:
+            raise OSError("No free inodes available.")
+        return index
+
+    def _free_inode(self, index):
+        with self.inode_alloc_lock:
+            self.inode_bitmap.clear(index)
+
+    def _alloc_extents(self, count):
+        with self.block_alloc_lock:
+            return self._alloc_extents_locked(count)
+
+    def _alloc_extents_locked(self, count):
+        """Allocate count blocks, as one contiguous run when one is free."""
+        if count == 0:
+            return []
+        if count > self.block_bitmap.free:
+            raise OSError("Not enough free data blocks available.")
+        start = self.block_bitmap.allocate(count)
+        if start >= 0:
+            return [(start, count)]
+        # No single run is long enough: take the largest pieces available,
+        # halving the run length whenever no run of that length is left.
+        extents = []
+        remaining = length = count
+        while remaining:
+            length = min(length, remaining)
+            start = self.block_bitmap.allocate(length)
+            if start < 0:
+                length //= 2
+                continue
+            if extents and extents[-1][0] + extents[-1][1] == start:
+                extents[-1] = (extents[-1][0], extents[-1][1] + length)
+            else:
+                extents.append((start, length))
+            remaining -= length
+        return extents
+
+    def _alloc_blocks(self, count):
+        return [block for start, length in self._alloc_extents(count)
+                for block in range(start, start + length)]
+
+    def _free_blocks(self, blocks):
+        self._release_extents([(block, 1) for block in blocks
+                               if self.sb.data_start <= block < self.sb.total_blocks
+                               and not self._is_held(block)])
+
+    def _free_extents(self, extents):
+        extents = [(start, length) for start, length in extents
+                   if self.sb.data_start <= start and start + length <= self.sb.total_blocks]
+        if self.dedup:
+            extents = self._unref_extents(extents)
+        if self.held is not None:
+            extents = self._unheld(extents)
+        self._release_extents(extents)
+
+    def _release_extents(self, extents):
+        # With a journal, freed blocks stay allocated until the commit
+        with self.block_alloc_lock:
+            if self.journal is not None:
+                self.freed.extend(extents)
                 return
-        content_bytes = content.encode('utf-8')
-        block_size = sp.block_size
-        num_blocks_needed = (len(content_bytes) + block_size - 1) // block_size
-        if num_blocks_needed > 10:
-            print("File too large for this simple file system (max 10 blocks).")
-            return
-        free_blocks = []
-        for i, bit in enumerate(block_bitmap):
-            if bit == 0:
-                free_blocks.append(i + sp.free_space_map_start + 1)
-                block_bitmap[i] = 1
-                if len(free_blocks) == num_blocks_needed:
+            for start, length in extents:
+                self.block_bitmap.clear_range(start, length)
+
+    # Deduplication
+    #
+    # A block with a nonzero refcount is in the hash index and may be shared
+    # by several files; refcount 0 means the block belongs to one file only,
+    # as on an image without dedup. The refcount table and index are
+    # metadata and go through the journal like the bitmaps.
+
+    def _refcounts(self, start, length):
+        data = self._read(self.sb.refcount_start * self.sb.block_size + start * REFCOUNT.size,
+                          length * REFCOUNT.size)
+        return [count for count, in REFCOUNT.iter_unpack(data)]
+
+    def _set_refcount(self, block_num, count):
+        self._write(self.sb.refcount_start * self.sb.block_size + block_num * REFCOUNT.size,
+                    REFCOUNT.pack(count))
+
+    def _index_bucket(self, digest):
+        """Image offset and slots of the index bucket digest belongs to."""
+        bucket = int.from_bytes(digest[:8], 'little') % self.sb.dedup_index_blocks
+        offset = (self.sb.dedup_index_start + bucket) * self.sb.block_size
+        data = self._read(offset, self.sb.block_size // DEDUP_INDEX_ENTRY.size * DEDUP_INDEX_ENTRY.size)
+        return offset, DEDUP_INDEX_ENTRY.iter_unpack(data)
+
+    def _index_find(self, digest, content):
+        """Return the indexed block holding content, or None."""
+        _, slots = self._index_bucket(digest)
+        for key, block_num in slots:
+            # Digests only select candidates; the bytes decide
+            if (block_num and key == digest and self._refcounts(block_num, 1)[0]
+                    and self.cache.read(block_num * self.sb.block_size, self.sb.block_size) == content):
+                return block_num
+        return None
+
+    def _index_replace(self, digest, old_block, new_block):
+        """Point the slot holding old_block (0: a free slot) at new_block; False if there is none."""
+        offset, slots = self._index_bucket(digest)
+        for slot, (key, block_num) in enumerate(slots):
+            if block_num == old_block and (not old_block or key == digest):
+                key = digest if new_block else bytes(DEDUP_DIGEST_SIZE)
+                self._write(offset + slot * DEDUP_INDEX_ENTRY.size, DEDUP_INDEX_ENTRY.pack(key, new_block))
+                return True
+        return False
+
+    def _unref_extents(self, extents):
+        """Drop one reference to every block of extents and return the runs now unused."""
+        unused = []
+        with self.dedup_lock:
+            for start, length in extents:
+                counts = self._refcounts(start, length)
+                if not any(counts):
+                    unused.append((start, length))
+                    continue
+                for block_num, count in zip(range(start, start + length), counts):
+                    if count > 1:
+                        self._set_refcount(block_num, count - 1)
+                        continue
+                    if count == 1:
+                        content = self.cache.read(block_num * self.sb.block_size, self.sb.block_size)
+                        self._index_replace(block_digest(content), block_num, 0)
+                        self._set_refcount(block_num, 0)
+                    unused.append((block_num, 1))
+        return unused
+
+    def _write_shared(self, inode, offset, data):
+        """_write_at() for dedup images: store each block written through the index."""
+        block_size = self.sb.block_size
+        end = offset + len(data)
+        blocks = list(inode.blocks())
+        with self.dedup_lock:
+            for index in range(offset // block_size, -(-end // block_size)):
+                start = index * block_size
+                lo, hi = max(offset, start) - start, min(end, start + block_size) - start
+                current = blocks[index] if index < len(blocks) else None
+                # Bytes past the end of the file are zeroed so equal files share their last block
+                valid = max(0, min(block_size, inode.file_size - start))
+                content = bytearray(block_size)
+                if current is not None and (lo > 0 or hi < valid):
+                    content[:valid] = self.cache.read(current * block_size, valid)
+                content[lo:hi] = data[start + lo - offset:start + hi - offset]
+                content = bytes(content)
+                digest = block_digest(content)
+                block_num = self._index_find(digest, content)
+                if block_num is not None:
+                    if block_num == current:
+                        continue
+                    self._set_refcount(block_num, self._refcounts(block_num, 1)[0] + 1)
+                else:
+                    if (current is not None and not self._refcounts(current, 1)[0]
+                            and not self._is_held(current)):
+                        block_num = current  # Unshared and not indexed: overwrite in place
+                    else:
+                        block_num = self._alloc_blocks(1)[0]
+                    self._write_data(block_num * block_size, content)
+                    if self._index_replace(digest, 0, block_num):
+                        self._set_refcount(block_num, 1)
+                    if block_num == current:
+                        continue
+                if current is None:
+                    blocks.append(block_num)
+                else:
+                    blocks[index] = block_num
+                    self._free_extents([(current, 1)])
+        inode.extents = extents_from_blocks(blocks)
+
+    # Snapshots
+    #
+    # A snapshot is a copy of the inode bitmap, inode table, block bitmap
+    # and dedup regions, so taking one costs metadata I/O only. Blocks
+    # marked used in any snapshot's block bitmap are held: they are never
+    # written in place, so a change to a held file, directory or extent
+    # chain goes to a new block first, and they stay allocated until the
+    # last snapshot holding them is deleted. A snapshot's block bitmap
+    # records only the blocks the filesystem uses: the snapshots' own
+    # copies and the table are tracked through the table instead, so
+    # deleting the oldest snapshot frees everything only it was keeping.
+
+    def snapshots(self):
+        """Return the snapshots of the image, oldest first."""
+        if not self.sb.snapshot_table:
+            return []
+        return unpack_snapshot_table(self._read(self.sb.snapshot_table * self.sb.block_size,
+                                                self.sb.block_size))
+
+    def _find_snapshot(self, name):
+        for snapshot in self.snapshots():
+            if snapshot.name == name:
+                return snapshot
+        raise FileNotFoundError(f"Snapshot '{name}' not found.")
+
+    def _held_blocks(self):
+        """Bitmap of the blocks any snapshot uses, or None without snapshots."""
+        snapshots = self.snapshots()
+        if not snapshots:
+            return None
+        nbytes = (self.sb.total_blocks + 7) // 8
+        bits = 0
+        for snapshot in snapshots:
+            frozen = snapshot.superblock(self.sb)
+            bits |= int.from_bytes(self._read(frozen.free_space_map_start * self.sb.block_size, nbytes), 'little')
+        return Bitmap(self.sb.total_blocks, bits.to_bytes(nbytes, 'little'), self.sb.block_size)
+
+    def _is_held(self, block_num):
+        return self.held is not None and self.held.is_set(block_num)
+
+    def _unheld(self, extents):
+        """The parts of extents no snapshot holds."""
+        unheld = []
+        for start, length in extents:
+            if self.held.free_run_at(start, length) == length:
+                unheld.append((start, length))
+            else:
+                unheld.extend((block_num, 1) for block_num in range(start, start + length)
+                              if not self.held.is_set(block_num))
+        return unheld
+
+    def _claimed_blocks(self):
+        """Bitmap of the blocks the live filesystem uses."""
+        claimed = Bitmap(self.sb.total_blocks)
+        claimed.set_range(0, self.sb.data_start)
+        if self.sb.snapshot_table:
+            claimed.set(self.sb.snapshot_table)
+        for index, inode in enumerate(self.read_inode_table()):
+            if not self.inode_bitmap.is_set(index):
+                continue
+            for start, length in inode.extents:
+                claimed.set_range(start, length)
+            for block_num, extents in self._extent_chain(inode.extent_block):
+                claimed.set(block_num)
+                for start, length in extents:
+                    claimed.set_range(start, length)
+        return claimed
+
+    def _copy_blocks(self, source, target, count, write):
+        block_size = self.sb.block_size
+        for done in range(0, count, COPY_CHUNK_BLOCKS):
+            chunk = min(COPY_CHUNK_BLOCKS, count - done)
+            write((target + done) * block_size, self._read((source + done) * block_size, chunk * block_size))
+
+    def _mark_snapshot_blocks(self, bitmap, snapshots):
+        """Mark the snapshot table and every snapshot's copy used in bitmap."""
+        bitmap.set(self.sb.snapshot_table)
+        for snapshot in snapshots:
+            bitmap.set_range(snapshot.start, snapshot_blocks(self.sb))
+
+    def snapshot(self, name):
+        """Record the current state of the filesystem as snapshot name and return it.
+
+        Waits for operations in flight, then copies the metadata regions
+        into one contiguous run of free blocks and commits.
+        """
+        self._check_writable()
+        encoded = name.encode('utf-8')
+        if not name or len(encoded) > MAX_SNAPSHOT_NAME or b'\x00' in encoded:
+            raise OSError(f"Invalid snapshot name '{name}'.")
+        with self.transaction_lock.write_locked():
+            # Commit first so blocks freed since are not frozen as in use
+            self.sync()
+            snapshots = self.snapshots()
+            if any(snapshot.name == name for snapshot in snapshots):
+                raise FileExistsError(f"Snapshot '{name}' already exists.")
+            if len(snapshots) >= self.sb.block_size // SNAPSHOT_ENTRY.size:
+                raise OSError("Snapshot table is full.")
+            if not self.sb.snapshot_table:
+                self.sb.snapshot_table = self._alloc_blocks(1)[0]
+                self._write(0, self.sb.pack())
+            with self.block_alloc_lock:
+                start = self.block_bitmap.allocate(snapshot_blocks(self.sb))
+            if start < 0:
+                raise OSError("Not enough contiguous free blocks for a snapshot.")
+            # The copied block bitmap includes the blocks just allocated
+            self._flush_bitmaps()
+            snapshot = Snapshot(name, time.time(), start)
+            frozen = snapshot.superblock(self.sb)
+            for start_field, blocks_field in SNAPSHOT_REGIONS:
+                self._copy_blocks(getattr(self.sb, start_field), getattr(frozen, start_field),
+                                  getattr(self.sb, blocks_field), self._write_data)
+            snapshots.append(snapshot)
+            frozen_map = self._claimed_blocks()
+            frozen_map.clear(self.sb.snapshot_table)
+            self._write_data(frozen.free_space_map_start * self.sb.block_size, frozen_map.to_bytes())
+            self._write(self.sb.snapshot_table * self.sb.block_size,
+                        pack_snapshot_table(snapshots, self.sb.block_size))
+            self.held = self._held_blocks()
+            self.sync()
+        return snapshot
+
+    def delete_snapshot(self, name):
+        """Forget snapshot name and free the blocks only it was holding."""
+        self._check_writable()
+        with self.transaction_lock.write_locked():
+            deleted = self._find_snapshot(name)
+            snapshots = [snapshot for snapshot in self.snapshots() if snapshot.name != name]
+            self._write(self.sb.snapshot_table * self.sb.block_size,
+                        pack_snapshot_table(snapshots, self.sb.block_size))
+            nbytes = (self.sb.total_blocks + 7) // 8
+            released = int.from_bytes(self.held.to_bytes(), 'little')
+            self.held = self._held_blocks()
+            if self.held is not None:
+                released &= ~int.from_bytes(self.held.to_bytes(), 'little')
+            released &= ~int.from_bytes(self._claimed_blocks().to_bytes(), 'little')
+            with self.block_alloc_lock:
+                for block_num in Bitmap(self.sb.total_blocks, released.to_bytes(nbytes, 'little')).set_indices():
+                    self.block_bitmap.clear(block_num)
+                self.block_bitmap.clear_range(deleted.start, snapshot_blocks(self.sb))
+            self.sync()
+
+    def rollback(self, name):
+        """Return the filesystem to the state recorded in snapshot name.
+
+        The snapshot itself and any others are kept. The current directory
+        goes back to the root, and open FileObjects must not be used
+        afterwards. A large inode table is restored over several journal
+        transactions; if a rollback is interrupted, running it again
+        completes it.
+        """
+        self._check_writable()
+        with self.transaction_lock.write_locked():
+            frozen = self._find_snapshot(name).superblock(self.sb)
+            for start_field, blocks_field in SNAPSHOT_REGIONS:
+                if start_field in ('inodes_bitmap_start', 'free_space_map_start'):
+                    continue
+                self._copy_blocks(getattr(frozen, start_field), getattr(self.sb, start_field),
+                                  getattr(self.sb, blocks_field), self._write)
+            with self.inode_alloc_lock:
+                self.inode_bitmap.load(self._read(frozen.inodes_bitmap_start * self.sb.block_size,
+                                                  len(self.inode_bitmap.bits)))
+            # Blocks used since the snapshot was taken are free again unless
+            # another snapshot holds them
+            with self.block_alloc_lock:
+                self.block_bitmap.load(self.held.to_bytes())
+                self._mark_snapshot_blocks(self.block_bitmap, self.snapshots())
+                self.freed = []
+            self.dentries.clear()
+            self.cwd = 0
+            self.sync()
+
+    # Directories
+    #
+    # A directory's data blocks are the buckets of a hash table keyed on
+    # directory_hash(name), so a lookup, insert or delete reads and writes a
+    # single block regardless of how many entries the directory holds. When
+    # a bucket overflows the table doubles, splitting every bucket in two.
+
+    def _directory_buckets(self, dir_inode_number, for_update=False):
+        inode = self.read_inode(dir_inode_number)
+        if not inode.is_directory:
+            raise NotADirectoryError("Current inode is not a directory.")
+        buckets = list(inode.blocks())
+        if not buckets:
+            raise OSError("Directory has no data block.")
+        if for_update and any(self._is_held(block) for block in buckets):
+            buckets = self._unshare_directory(dir_inode_number, inode, buckets)
+        return inode, buckets
+
+    def _unshare_directory(self, dir_inode_number, inode, buckets):
+        """Move a directory a snapshot holds to new buckets before it changes."""
+        new_buckets = [block for start, length in self._alloc_extents(len(buckets))
+                       for block in range(start, start + length)]
+        for old, new in zip(buckets, new_buckets):
+            self._write(new * self.sb.block_size, self._read(old * self.sb.block_size, self.sb.block_size))
+        self._free_extents(inode.extents)
+        inode.extents = extents_from_blocks(new_buckets)
+        self.write_inode(dir_inode_number, inode)
+        return new_buckets
+
+    def _read_bucket(self, block_num):
+        return unpack_directory_bucket(self._read(block_num * self.sb.block_size,
+                                                  self.sb.block_size))
+
+    def _write_bucket(self, block_num, entries):
+        self._write(block_num * self.sb.block_size,
+                    pack_directory_bucket(entries, self.sb.block_size))
+
+    def _bucket_fits(self, entries):
+        used = DIR_BUCKET_HEADER.size + sum(entry.packed_size() for entry in entries)
+        return used <= self.sb.block_size
+
+    def _new_directory_block(self):
+        block_num = self._alloc_blocks(1)[0]
+        self._write_bucket(block_num, [])
+        return block_num
+
+    def _grow_directory(self, dir_inode_number, inode, buckets):
+        count = len(buckets)
+        # Every bucket is rewritten along with the inode, its extent chain
+        # and the bitmap; refuse up front rather than outgrow the journal
+        if self.journal is not None and not self.journal.has_room(
+                2 * count + len(inode.extents) * EXTENT.size // self.sb.block_size + 6):
+            raise OSError("Directory is too large to grow within the journal.")
+        new_extents = self._alloc_extents(count)
+        new_buckets = buckets + [block for start, length in new_extents
+                                 for block in range(start, start + length)]
+        mask = count * 2 - 1
+        for index in range(count):
+            low, high = [], []
+            for entry in self._read_bucket(buckets[index]):
+                (high if directory_hash(entry.name) & mask >= count else low).append(entry)
+            self._write_bucket(new_buckets[index], low)
+            self._write_bucket(new_buckets[index + count], high)
+        inode.extents = extents_from_blocks(new_buckets)
+        inode.file_size = len(new_buckets) * self.sb.block_size
+        self.write_inode(dir_inode_number, inode)
+        return new_buckets
+
+    def _dir_lookup(self, dir_inode_number, name):
+        entry = self.dentries.get(dir_inode_number, name)
+        if entry is not _MISSING:
+            return entry
+        with self.locks.read(dir_inode_number):
+            _, buckets = self._directory_buckets(dir_inode_number)
+            bucket = buckets[directory_hash(name) & (len(buckets) - 1)]
+            found = None
+            for entry in self._read_bucket(bucket):
+                if entry.name == name:
+                    found = entry
                     break
-        if len(free_blocks) < num_blocks_needed:
-            print("Not enough free data blocks available.")
-            return
-        for index, block_num in enumerate(free_blocks):
-            data_offset = block_num * block_size
-            fs.seek(data_offset)
-            start = index * block_size
-            end = start + block_size
-            fs.write(content_bytes[start:end])
-        write_block_bitmap(fs, block_bitmap)
-        inode_bitmap = read_inode_bitmap(fs)
-        free_inode_index = None
-        for index, bit in enumerate(inode_bitmap):
-            if bit == 0:
-                free_inode_index = index
-                inode_bitmap[index] = 1
+            # Cached under the lock so a concurrent insert cannot be
+            # shadowed by a stale negative entry
+            self.dentries.put(dir_inode_number, name, found)
+        return found
+
+    def _dir_entries(self, dir_inode_number):
+        """Yield the entries of a directory, reading one bucket at a time.
+
+        The read lock is taken per bucket, so entries added or removed
+        during the iteration may or may not be seen, as with os.scandir().
+        Buckets are visited in bit-reversed order: when the table doubles,
+        bucket i splits into i and i + count, and the remaining buckets are
+        still exactly those the cursor has not reached, so no entry is
+        seen twice or skipped because of the growth.
+        """
+        cursor = 0
+        while True:
+            with self.locks.read(dir_inode_number):
+                _, buckets = self._directory_buckets(dir_inode_number)
+                entries = self._read_bucket(buckets[cursor])
+            yield from entries
+            bits = (len(buckets) - 1).bit_length()
+            cursor = _reverse_bits(cursor, bits) + 1
+            if cursor >> bits:
+                return
+            cursor = _reverse_bits(cursor, bits)
+
+    def _check_name(self, name):
+        if not name or '/' in name or name in ('.', '..'):
+            raise OSError(f"Invalid name '{name}'.")
+        if len(name.encode('utf-8')) > MAX_NAME_LENGTH:
+            raise OSError(f"Name '{name}' is too long.")
+
+    def _dir_insert(self, dir_inode_number, entry):
+        self._check_name(entry.name)
+        inode, buckets = self._directory_buckets(dir_inode_number, for_update=True)
+        name_hash = directory_hash(entry.name)
+        while True:
+            bucket = buckets[name_hash & (len(buckets) - 1)]
+            entries = self._read_bucket(bucket)
+            entries.append(entry)
+            if self._bucket_fits(entries):
                 break
-        if free_inode_index is None:
-            print("No free inodes available.")
-            return
-        inode = Inode()
-        inode.file_size = len(content_bytes)
-        inode.creation_time = time.time()
-        inode.modification_time = time.time()
-        for i, block_num in enumerate(free_blocks):
-            inode.direct_blocks[i] = block_num
-        write_inode(fs, free_inode_index, inode)
-        write_inode_bitmap(fs, inode_bitmap)
-        fs.seek(dir_offset)
-        try:
-            dir_entries = pickle.load(fs)
-        except Exception:
-            dir_entries = []
-        dir_entries.append(DirectoryEntry(filename, free_inode_index))
-        fs.seek(dir_offset)
-        fs.write(pickle.dumps(dir_entries))
-        print(f"File '{filename}' created in {fs_image} with content: {content}")
+            buckets = self._grow_directory(dir_inode_number, inode, buckets)
+        self._write_bucket(bucket, entries)
+        self.dentries.put(dir_inode_number, entry.name, entry)
 
-def readFile(fs_image, filename):
-    with open(fs_image, 'rb') as fs:
-        root_inode = read_inode(fs, 0)
-        root_dir_block = root_inode.direct_blocks[0]
-        dir_offset = root_dir_block * sp.block_size
-        fs.seek(dir_offset)
-        try:
-            dir_entries = pickle.load(fs)
-        except Exception:
-            print("Failed to read directory entries.")
-            return
-        file_inode_num = None
-        for entry in dir_entries:
-            if entry.name == filename:
-                file_inode_num = entry.inode_number
+    def _dir_insert_many(self, dir_inode_number, entries):
+        """Insert a batch of entries, growing the table first and writing each bucket once."""
+        for entry in entries:
+            self._check_name(entry.name)
+        inode, buckets = self._directory_buckets(dir_inode_number, for_update=True)
+        while True:
+            groups = {}
+            for entry in entries:
+                groups.setdefault(directory_hash(entry.name) & (len(buckets) - 1), []).append(entry)
+            merged = {}
+            for index, new_entries in groups.items():
+                combined = self._read_bucket(buckets[index]) + new_entries
+                if not self._bucket_fits(combined):
+                    break
+                merged[index] = combined
+            else:
                 break
-        if file_inode_num is None:
-            print(f"File '{filename}' not found.")
-            return
-        inode = read_inode(fs, file_inode_num)
-        content_bytes = b''
-        bytes_left = inode.file_size
-        for block_num in inode.direct_blocks:
-            if block_num is not None and bytes_left > 0:
-                data_offset = block_num * sp.block_size
-                fs.seek(data_offset)
-                to_read = min(bytes_left, sp.block_size)
-                content_bytes += fs.read(to_read)
-                bytes_left -= to_read
-        print(content_bytes.decode('utf-8'))
+            buckets = self._grow_directory(dir_inode_number, inode, buckets)
+        for index, combined in merged.items():
+            self._write_bucket(buckets[index], combined)
+        for entry in entries:
+            self.dentries.put(dir_inode_number, entry.name, entry)
 
-def deleteFile(fs_image, filename):
-    with open(fs_image, 'r+b') as fs:
-        root_inode = read_inode(fs, 0)
-        root_dir_block = root_inode.direct_blocks[0]
-        if root_dir_block is None:
-            print("Root directory is empty.")
+    def _dir_remove(self, dir_inode_number, name):
+        _, buckets = self._directory_buckets(dir_inode_number, for_update=True)
+        bucket = buckets[directory_hash(name) & (len(buckets) - 1)]
+        entries = self._read_bucket(bucket)
+        for index, entry in enumerate(entries):
+            if entry.name == name:
+                del entries[index]
+                self._write_bucket(bucket, entries)
+                self.dentries.put(dir_inode_number, name, None)
+                return entry
+        return None
+
+    # Paths
+
+    def _components(self, path):
+        start = 0 if path.startswith('/') else self.cwd
+        return start, [part for part in path.split('/') if part and part != '.']
+
+    def _walk(self, start, components, path, kind):
+        inode_number = start
+        for component in components:
+            if component == '..':
+                inode_number = self.read_inode(inode_number).parent
+                continue
+            entry = self._dir_lookup(inode_number, component)
+            if entry is None:
+                raise FileNotFoundError(f"{kind} '{path}' not found.")
+            inode_number = entry.inode_number
+        return inode_number
+
+    def resolve(self, path, kind='File'):
+        """Return the inode number path refers to."""
+        start, components = self._components(path)
+        return self._walk(start, components, path, kind)
+
+    def _resolve_parent(self, path):
+        """Return (parent directory inode, final name) for path."""
+        start, components = self._components(path)
+        if not components or components[-1] == '..':
+            raise OSError(f"Invalid path '{path}'.")
+        parent = self._walk(start, components[:-1], path, 'Directory')
+        if not self.read_inode(parent).is_directory:
+            raise NotADirectoryError(f"'{path}' is not inside a directory.")
+        return parent, components[-1]
+
+    def lookup(self, path):
+        return self.resolve(path)
+
+    # File data
+
+    def _file_segments(self, inode, offset, size):
+        """Yield (image offset, length) for each contiguous piece of a file range."""
+        block_size = self.sb.block_size
+        block_index, skip = divmod(offset, block_size)
+        for start, length in inode.extents:
+            if size <= 0:
+                return
+            if block_index >= length:
+                block_index -= length
+                continue
+            count = min(size, (length - block_index) * block_size - skip)
+            yield (start + block_index) * block_size + skip, count
+            size -= count
+            block_index = skip = 0
+
+    def _read_at(self, inode, offset, size):
+        """Return views covering up to size bytes of the file from offset."""
+        size = min(size, inode.file_size - offset)
+        if size <= 0:
+            return []
+        return [self.cache.view(position, count)
+                for position, count in self._file_segments(inode, offset, size)]
+
+    def _reserve(self, inode, block_count):
+        """Grow the file's block map to block_count blocks."""
+        needed = block_count - inode.block_count()
+        if needed <= 0:
             return
-        dir_offset = root_dir_block * sp.block_size
-        fs.seek(dir_offset)
-        try:
-            dir_entries = pickle.load(fs)
-        except Exception:
-            print("No directory entries found.")
+        if inode.extents:
+            # Extend the last extent in place when the following blocks
+            # are free, so streamed appends stay contiguous.
+            start, length = inode.extents[-1]
+            with self.block_alloc_lock:
+                grow = self.block_bitmap.free_run_at(start + length, needed)
+                self.block_bitmap.set_range(start + length, grow)
+            if grow:
+                inode.extents[-1] = (start, length + grow)
+                needed -= grow
+        for start, length in self._alloc_extents(needed):
+            last_start, last_length = inode.extents[-1] if inode.extents else (None, 0)
+            if last_start is not None and last_start + last_length == start:
+                inode.extents[-1] = (last_start, last_length + length)
+            else:
+                inode.extents.append((start, length))
+
+    def _release(self, inode, block_count):
+        """Shrink the file's block map to its first block_count blocks."""
+        kept = []
+        for start, length in inode.extents:
+            if block_count >= length:
+                kept.append((start, length))
+                block_count -= length
+            elif block_count > 0:
+                kept.append((start, block_count))
+                self._free_extents([(start + block_count, length - block_count)])
+                block_count = 0
+            else:
+                self._free_extents([(start, length)])
+        inode.extents = kept
+
+    def _write_at(self, inode, offset, data):
+        if offset > inode.file_size:
+            self._resize(inode, offset)
+        view = memoryview(data).cast('B')
+        end = offset + len(view)
+        if self.dedup:
+            self._write_shared(inode, offset, view)
+        else:
+            self._reserve(inode, -(-end // self.sb.block_size))
+            if self.held is not None:
+                self._unshare_blocks(inode, offset // self.sb.block_size, -(-end // self.sb.block_size))
+            written = 0
+            for position, count in self._file_segments(inode, offset, len(view)):
+                self._write_data(position, view[written:written + count])
+                written += count
+        inode.file_size = max(inode.file_size, end)
+        inode.modification_time = time.time()
+
+    def _unshare_blocks(self, inode, first, last):
+        """Copy the file's blocks first..last-1 that a snapshot holds to new blocks."""
+        block_size = self.sb.block_size
+        blocks = list(inode.blocks())
+        held = [index for index in range(first, min(last, len(blocks))) if self.held.is_set(blocks[index])]
+        if not held:
             return
-        entry_to_remove = None
-        for entry in dir_entries:
-            if entry.name == filename:
-                entry_to_remove = entry
-                break
-        if not entry_to_remove:
-            print(f"File '{filename}' not found.")
+        copies = [block for start, length in self._alloc_extents(len(held))
+                  for block in range(start, start + length)]
+        for index, copy in zip(held, copies):
+            self._write_data(copy * block_size, self.cache.read(blocks[index] * block_size, block_size))
+            self._free_extents([(blocks[index], 1)])
+            blocks[index] = copy
+        inode.extents = extents_from_blocks(blocks)
+
+    def _resize(self, inode, size):
+        if size < 0:
+            raise ValueError(f"Negative size ({size}).")
+        if size < inode.file_size:
+            self._release(inode, -(-size // self.sb.block_size))
+            inode.file_size = size
+            inode.modification_time = time.time()
             return
-        dir_entries.remove(entry_to_remove)
-        inode_bitmap = read_inode_bitmap(fs)
-        inode_bitmap[entry_to_remove.inode_number] = 0
-        write_inode_bitmap(fs, inode_bitmap)
-        inode = read_inode(fs, entry_to_remove.inode_number)
-        block_bitmap = read_block_bitmap(fs)
-        for block in inode.direct_blocks:
-            if block is not None:
-                block_index = block - sp.free_space_map_start - 1
-                if 0 <= block_index < len(block_bitmap):
-                    block_bitmap[block_index] = 0
-        write_block_bitmap(fs, block_bitmap)
-        write_inode(fs, entry_to_remove.inode_number, Inode())
-        fs.seek(dir_offset)
-        fs.write(pickle.dumps(dir_entries))
-        print(f"File '{filename}' deleted from {fs_image}.")
+        # Zero-fill the gap so stale bytes past the old end never show through
+        chunk = bytes(min(size - inode.file_size, 1 << 20))
+        while inode.file_size < size:
+            self._write_at(inode, inode.file_size, chunk[:size - inode.file_size])
 
-def mkdir(fs_image, dirname):
-    with open(fs_image, 'r+b') as fs:
-        # First check if a directory with this name already exists
-        root_inode = read_inode(fs, 0)
-        root_dir_block = root_inode.direct_blocks[0]
-        root_dir_offset = root_dir_block * sp.block_size
-        fs.seek(root_dir_offset)
+    # Operations
+
+    def _check_writable(self):
+        if self.read_only:
+            raise OSError(f"'{self.fs_image}' is mounted read-only.")
+
+    @_transaction
+    def _create(self, path, is_directory=False):
+        self._check_writable()
+        parent, name = self._resolve_parent(path)
+        with self.locks.write(parent):
+            if self._dir_lookup(parent, name) is not None:
+                kind = 'Directory' if is_directory else 'File'
+                raise FileExistsError(f"{kind} '{path}' already exists.")
+            inode_number = self._alloc_inode()
+            inode = Inode()
+            inode.is_directory = is_directory
+            inode.parent = parent
+            try:
+                if is_directory:
+                    inode.extents = [(self._new_directory_block(), 1)]
+                    inode.file_size = self.sb.block_size
+                self.write_inode(inode_number, inode)
+                self._dir_insert(parent, DirectoryEntry(name, inode_number, is_directory))
+            except OSError:
+                self._free_extents(inode.extents)
+                self._free_inode(inode_number)
+                raise
+            return inode_number
+
+    @_transaction
+    def open(self, path, mode='r'):
+        """Open path and return a FileObject; 'w', 'a' and 'x' create it."""
+        if not mode or mode.strip('rwax+b') or sum(mode.count(c) for c in 'rwax') != 1:
+            raise ValueError(f"Invalid mode '{mode}'.")
+        if mode.strip('rb'):
+            self._check_writable()
         try:
-            dir_entries = pickle.load(fs)
-            # Check if directory with same name exists
-            for entry in dir_entries:
-                if entry.name == dirname:
-                    print(f"Directory '{dirname}' already exists.")
-                    return
-        except Exception:
-            dir_entries = []
-
-        inode_bitmap = read_inode_bitmap(fs)
-        free_inode_index = None
-        for index, bit in enumerate(inode_bitmap):
-            if bit == 0:
-                free_inode_index = index
-                inode_bitmap[index] = 1
-                break
-        if free_inode_index is None:
-            print("No free inodes available.")
-            return
-        block_bitmap = read_block_bitmap(fs)
-        free_block = None
-        for i, bit in enumerate(block_bitmap):
-            if bit == 0:
-                free_block = i + sp.free_space_map_start + 1
-                block_bitmap[i] = 1
-                break
-        if free_block is None:
-            print("No free data blocks available.")
-            return
-        inode = Inode()
-        inode.is_directory = True
-        inode.file_size = 0
-        inode.creation_time = time.time()
-        inode.modification_time = time.time()
-        inode.direct_blocks[0] = free_block
-        write_inode(fs, free_inode_index, inode)
-        write_inode_bitmap(fs, inode_bitmap)
-        # Initialize the new directory block with an empty list
-        dir_offset = free_block * sp.block_size
-        fs.seek(dir_offset)
-        pickle.dump([], fs)
-        # Update the parent directory (root)
-        root_inode = read_inode(fs, 0)
-        root_dir_block = root_inode.direct_blocks[0]
-        root_dir_offset = root_dir_block * sp.block_size
-        fs.seek(root_dir_offset)
+            inode_number = self.resolve(path)
+        except FileNotFoundError:
+            if 'r' in mode:
+                raise
+            try:
+                inode_number = self._create(path)
+            except FileExistsError:
+                # Another thread created it first
+                if 'x' in mode:
+                    raise
+                inode_number = self.resolve(path)
+        else:
+            if 'x' in mode:
+                raise FileExistsError(f"File '{path}' already exists.")
+        file_object = FileObject(self, inode_number, mode)
+        if file_object.inode.is_directory:
+            raise IsADirectoryError(f"'{path}' is a directory.")
+        if 'w' in mode:
+            file_object.truncate(0)
+        return file_object
+
+    @_transaction
+    def createFile(self, filename, content):
+        file_object = self.open(filename, 'x')
         try:
-            dir_entries = pickle.load(fs)
-        except Exception:
-            dir_entries = []
-        dir_entries.append(DirectoryEntry(dirname, free_inode_index))
-        # Re-seek and overwrite the directory entries
-        fs.seek(root_dir_offset)
-        pickle.dump(dir_entries, fs)
-        fs.flush()  # Force write to disk
+            with file_object:
+                file_object.write(content)
+        except OSError:
+            self.deleteFile(filename)
+            raise
+        return file_object.inode_number
 
-        # Zero-fill the rest of the block
-        end_pos = fs.tell()
-        bytes_used = end_pos - root_dir_offset
-        padding = sp.block_size - (bytes_used % sp.block_size)
+    def read_bytes(self, filename, zero_copy=False):
+        """Return the contents of filename.
 
-        if padding < sp.block_size:  # Don't pad if we're exactly at block boundary
-            fs.write(b'\x00' * padding)
-        fs.flush()  # Make sure padding is written
+        Each extent is fetched with a single read. With zero_copy=True a
+        file stored in one extent is returned as a memoryview over the
+        image (a true zero-copy view when the image is memory-mapped);
+        fragmented files are joined into a single buffer. Otherwise a
+        bytes object is returned.
+        """
+        inode_number = self.lookup(filename)
+        with self.locks.read(inode_number):
+            inode = self.read_inode(inode_number)
+            if inode.is_directory:
+                raise IsADirectoryError(f"'{filename}' is a directory.")
+            views = self._read_at(inode, 0, inode.file_size)
+            if zero_copy and len(views) == 1:
+                return views[0]
+            return b''.join(views)
 
-        write_block_bitmap(fs, block_bitmap)
-        print(f"Directory '{dirname}' created in {fs_image}.")
+    def read_range(self, inode_number, offset=0, size=-1):
+        """Return up to size bytes of an inode's contents from offset (all if size < 0)."""
+        with self.locks.read(inode_number):
+            inode = self.read_inode(inode_number)
+            if inode.is_directory:
+                raise IsADirectoryError(f"Inode {inode_number} is a directory.")
+            if size < 0:
+                size = inode.file_size - offset
+            return b''.join(self._read_at(inode, offset, size))
 
-def chdir(fs_image, dirname, cwd_inode_number=0):
-    with open(fs_image, 'rb') as fs:
-        current_inode = read_inode(fs, cwd_inode_number)
-        if not current_inode.is_directory:
-            print("Current inode is not a directory.")
-            return cwd_inode_number
-        dir_block = current_inode.direct_blocks[0]
-        if dir_block is None:
-            print("Directory is empty.")
-            return cwd_inode_number
-        dir_offset = dir_block * sp.block_size
-        fs.seek(dir_offset)
-        try:
-            dir_entries = pickle.load(fs)
-        except Exception:
-            print("Failed to read directory entries.")
-            return cwd_inode_number
-        for entry in dir_entries:
-            if entry.name == dirname:
-                dest_inode = read_inode(fs, entry.inode_number)
-                if dest_inode.is_directory:
-                    print(f"Changed directory to '{dirname}'.")
-                    return entry.inode_number
-                else:
-                    print(f"'{dirname}' is not a directory.")
-                    return cwd_inode_number
-        print(f"Directory '{dirname}' not found.")
-        return cwd_inode_number
+    def readFile(self, filename):
+        return bytes(self.read_bytes(filename)).decode('utf-8')
 
-def move(fs_image, source_name, target_dir_name, cwd_inode_number=0):
-    with open(fs_image, 'r+b') as fs:
-        current_inode = read_inode(fs, cwd_inode_number)
-        if not current_inode.is_directory:
-            print("Current inode is not a directory.")
-            return
-        dir_block = current_inode.direct_blocks[0]
-        if dir_block is None:
-            print("Current directory is empty.")
-            return
-        dir_offset = dir_block * sp.block_size
-        fs.seek(dir_offset)
+    @_transaction
+    def deleteFile(self, filename):
+        self._check_writable()
+        parent, name = self._resolve_parent(filename)
+        entry = self._dir_lookup(parent, name)
+        if entry is None:
+            raise FileNotFoundError(f"File '{filename}' not found.")
+        with self.locks.write(parent, entry.inode_number):
+            # The entry may have gone while the locks were being taken
+            current = self._dir_lookup(parent, name)
+            if current is None or current.inode_number != entry.inode_number:
+                raise FileNotFoundError(f"File '{filename}' not found.")
+            inode = self.read_inode(entry.inode_number)
+            if inode.is_directory:
+                if next(self._dir_entries(entry.inode_number), None) is not None:
+                    raise OSError(f"Directory '{filename}' is not empty.")
+                if entry.inode_number == self.cwd:
+                    self.cwd = parent
+                self.dentries.invalidate_directory(entry.inode_number)
+            self._dir_remove(parent, name)
+            self._free_extents(inode.extents)
+            self._free_blocks([block for block, _ in self._extent_chain(inode.extent_block)])
+            self._free_inode(entry.inode_number)
+            # Leave a free, all-zero slot, as in a fresh image
+            self._write(self.sb.inode_table_start * self.sb.block_size + entry.inode_number * INODE_SIZE,
+                        bytes(INODE_SIZE))
+
+    def mkdir(self, dirname):
+        return self._create(dirname, is_directory=True)
+
+    def chdir(self, dirname):
+        inode_number = self.resolve(dirname, 'Directory')
+        if not self.read_inode(inode_number).is_directory:
+            raise NotADirectoryError(f"'{dirname}' is not a directory.")
+        self.cwd = inode_number
+        return self.cwd
+
+    def listdir(self, dirname='.'):
+        return [entry.name for entry in self.scandir(dirname)]
+
+    def _resolve_directory(self, dirname):
+        inode_number = self.resolve(dirname, 'Directory')
+        if not self.peek_inode(inode_number).is_directory:
+            raise NotADirectoryError(f"'{dirname}' is not a directory.")
+        return inode_number
+
+    def _scan(self, dir_inode_number, dir_path):
+        return (ScanEntry(self, dir_path, entry) for entry in self._dir_entries(dir_inode_number))
+
+    def scandir(self, dirname='.'):
+        """Return an iterator of ScanEntry objects for the entries of dirname."""
+        return self._scan(self._resolve_directory(dirname), dirname)
+
+    def walk(self, top='.', topdown=True, onerror=None):
+        """Yield (dirpath, dirs, files) for top and every directory below it.
+
+        Like os.walk(), but dirs and files are lists of ScanEntry objects.
+        With topdown=True a directory is yielded before its subdirectories
+        and removing entries from dirs prunes them from the walk; otherwise
+        it is yielded after them. The walk is iterative and holds only the
+        listings of the directories on the current path. Errors listing a
+        directory are passed to onerror if given and otherwise skipped.
+        """
         try:
-            dir_entries = pickle.load(fs)
-        except Exception:
-            print("Failed to read directory entries.")
+            stack = [(top, self._resolve_directory(top), None)]
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
             return
-        source_entry = None
-        for entry in dir_entries:
-            if entry.name == source_name:
-                source_entry = entry
-                break
-        if not source_entry:
-            print(f"Source '{source_name}' not found in current directory.")
-            return
-        target_dir_entry = None
-        for entry in dir_entries:
-            if entry.name == target_dir_name:
-                target_dir_entry = entry
-                break
-        if not target_dir_entry:
-            print(f"Target directory '{target_dir_name}' not found in current directory.")
-            return
-        target_inode = read_inode(fs, target_dir_entry.inode_number)
-        if not target_inode.is_directory:
-            print(f"Target '{target_dir_name}' is not a directory.")
-            return
-        dir_entries.remove(source_entry)
-        fs.seek(dir_offset)
-        fs.write(pickle.dumps(dir_entries))
-        target_dir_block = target_inode.direct_blocks[0]
-        if target_dir_block is None:
-            print(f"Target directory '{target_dir_name}' has no data block.")
-            return
-        target_dir_offset = target_dir_block * sp.block_size
-        fs.seek(target_dir_offset)
-        try:
-            target_dir_entries = pickle.load(fs)
-        except Exception:
-            target_dir_entries = []
-        target_dir_entries.append(source_entry)
-        fs.seek(target_dir_offset)
-        fs.write(pickle.dumps(target_dir_entries))
-        print(f"Moved '{source_name}' to directory '{target_dir_name}'.")
+        while stack:
+            dir_path, inode_number, listing = stack.pop()
+            if listing is not None:
+                yield (dir_path,) + listing
+                continue
+            dirs, files = [], []
+            try:
+                for entry in self._scan(inode_number, dir_path):
+                    (dirs if entry.is_directory else files).append(entry)
+            except OSError as e:
+                if onerror is not None:
+                    onerror(e)
+                continue
+            if topdown:
+                yield dir_path, dirs, files
+            else:
+                stack.append((dir_path, inode_number, (dirs, files)))
+            stack.extend((entry.path, entry.inode_number, None) for entry in reversed(dirs))
 
-def print_root_directory(fs_image):
-    with open(fs_image, 'rb') as fs:
-        root_inode = read_inode(fs, 0)
-        root_dir_block = root_inode.direct_blocks[0]
-        if root_dir_block is None:
-            print("Root directory is empty.")
-            return
-        dir_offset = root_dir_block * sp.block_size
-        fs.seek(dir_offset)
-        try:
-            dir_entries = pickle.load(fs)
-            print("Root directory entries:")
-            for entry in dir_entries:
-                print(f"  Name: {entry.name}, Inode: {entry.inode_number}")
-        except Exception as e:
-            print("Failed to read directory entries:", e)
+    @_transaction
+    def move(self, source_name, target_dir_name):
+        self._check_writable()
+        # Moves are serialised so the ancestry check cannot race another move
+        with self.rename_lock:
+            source_parent, name = self._resolve_parent(source_name)
+            source_entry = self._dir_lookup(source_parent, name)
+            if source_entry is None:
+                raise FileNotFoundError(f"Source '{source_name}' not found.")
+            target = self.resolve(target_dir_name, 'Target directory')
+            with self.locks.write(source_parent, target, source_entry.inode_number):
+                current = self._dir_lookup(source_parent, name)
+                if current is None or current.inode_number != source_entry.inode_number:
+                    raise FileNotFoundError(f"Source '{source_name}' not found.")
+                target_inode = self.read_inode(target)
+                if not target_inode.is_directory:
+                    raise NotADirectoryError(f"Target '{target_dir_name}' is not a directory.")
+                if not target_inode.extents:
+                    raise OSError(f"Target directory '{target_dir_name}' has no data block.")
+                if self._dir_lookup(target, name) is not None:
+                    raise FileExistsError(f"'{name}' already exists in '{target_dir_name}'.")
+                moved_inode = self.read_inode(source_entry.inode_number)
+                if moved_inode.is_directory:
+                    # Refuse to move a directory underneath itself
+                    ancestor = target
+                    while True:
+                        if ancestor == source_entry.inode_number:
+                            raise OSError(f"Cannot move '{source_name}' into itself.")
+                        if ancestor == 0:
+                            break
+                        ancestor = self.read_inode(ancestor).parent
+                # Add to the target before removing from the source so a failure
+                # never leaves the entry in neither directory.
+                self._dir_insert(target, source_entry)
+                self._dir_remove(source_parent, name)
+                moved_inode.parent = target
+                self.write_inode(source_entry.inode_number, moved_inode)
 
-def print_directory_tree(fs_image, inode_number=0, indent=0):
-    with open(fs_image, 'rb') as fs:
-        inode = read_inode(fs, inode_number)
+    def print_root_directory(self):
+        print("Root directory entries:")
+        for entry in self.scandir('/'):
+            print(f"  Name: {entry.name}, Inode: {entry.inode_number}")
+
+    def print_directory_tree(self, inode_number=0, indent=0):
+        inode = self.peek_inode(inode_number)
         if not inode.is_directory:
             print(" " * indent + f"(file) inode {inode_number}")
             return
-        dir_block = inode.direct_blocks[0]
-        if dir_block is None:
+        if not inode.extents:
             print(" " * indent + f"(empty dir) inode {inode_number}")
             return
-        dir_offset = dir_block * sp.block_size
-        fs.seek(dir_offset)
         try:
-            dir_entries = pickle.load(fs)
+            stack = [(self._scan(inode_number, ''), indent)]
         except Exception:
             print(" " * indent + "(unreadable directory)")
             return
-
-        for entry in dir_entries:
-            entry_inode = read_inode(fs, entry.inode_number)
-            if entry_inode.is_directory:
-                print(" " * indent + f"[DIR] {entry.name} (inode {entry.inode_number})")
-                print_directory_tree(fs_image, entry.inode_number, indent + 4)
-            else:
+        # Depth-first with an explicit stack of listings, so deep trees
+        # never hit the recursion limit
+        while stack:
+            entries, indent = stack[-1]
+            entry = next(entries, None)
+            if entry is None:
+                stack.pop()
+                continue
+            if not entry.is_directory:
                 print(" " * indent + f"[FILE] {entry.name} (inode {entry.inode_number})")
+                continue
+            print(" " * indent + f"[DIR] {entry.name} (inode {entry.inode_number})")
+            if not entry.stat().extents:
+                print(" " * (indent + 4) + f"(empty dir) inode {entry.inode_number}")
+                continue
+            try:
+                stack.append((self._scan(entry.inode_number, entry.path), indent + 4))
+            except Exception:
+                print(" " * (indent + 4) + "(unreadable directory)")
+
+def createFile(fs_image, filename, content):
+    try:
+        with FileSystem(fs_image) as fs:
+            fs.createFile(filename, content)
+    except OSError as e:
+        print(e)
+        return
+    print(f"File '{filename}' created in {fs_image} with content: {content}")
+
+def readFile(fs_image, filename):
+    try:
+        with FileSystem(fs_image) as fs:
+            content = fs.readFile(filename)
+    except OSError as e:
+        print(e)
+        return
+    print(content)
+
+def deleteFile(fs_image, filename):
+    try:
+        with FileSystem(fs_image) as fs:
+            fs.deleteFile(filename)
+    except OSError as e:
+        print(e)
+        return
+    print(f"File '{filename}' deleted from {fs_image}.")
+
+def mkdir(fs_image, dirname):
+    try:
+        with FileSystem(fs_image) as fs:
+            fs.mkdir(dirname)
+    except OSError as e:
+        print(e)
+        return
+    print(f"Directory '{dirname}' created in {fs_image}.")
+
+def chdir(fs_image, dirname, cwd_inode_number=0):
+    try:
+        with FileSystem(fs_image, cwd_inode_number) as fs:
+            cwd_inode_number = fs.chdir(dirname)
+    except OSError as e:
+        print(e)
+        return cwd_inode_number
+    print(f"Changed directory to '{dirname}'.")
+    return cwd_inode_number
+
+def move(fs_image, source_name, target_dir_name, cwd_inode_number=0):
+    try:
+        with FileSystem(fs_image, cwd_inode_number) as fs:
+            fs.move(source_name, target_dir_name)
+    except OSError as e:
+        print(e)
+        return
+    print(f"Moved '{source_name}' to directory '{target_dir_name}'.")
+
+def print_root_directory(fs_image):
+    try:
+        with FileSystem(fs_image) as fs:
+            fs.print_root_directory()
+    except OSError as e:
+        print("Failed to read directory entries:", e)
+
+def print_directory_tree(fs_image, inode_number=0, indent=0):
+    with FileSystem(fs_image) as fs:
+        fs.print_directory_tree(inode_number, indent)
+
+def snapshot(fs_image, name):
+    try:
+        with FileSystem(fs_image) as fs:
+            fs.snapshot(name)
+    except OSError as e:
+        print(e)
+        return
+    print(f"Snapshot '{name}' of {fs_image} created.")
+
+def list_snapshots(fs_image):
+    try:
+        with FileSystem(fs_image) as fs:
+            snapshots = fs.snapshots()
+    except OSError as e:
+        print(e)
+        return
+    for entry in snapshots:
+        print(f"  {entry.name}  {time.ctime(entry.created)}")
+
+def delete_snapshot(fs_image, name):
+    try:
+        with FileSystem(fs_image) as fs:
+            fs.delete_snapshot(name)
+    except OSError as e:
+        print(e)
+        return
+    print(f"Snapshot '{name}' deleted from {fs_image}.")
+
+def rollback(fs_image, name):
+    try:
+        with FileSystem(fs_image) as fs:
+            fs.rollback(name)
+    except OSError as e:
+        print(e)
+        return
+    print(f"Rolled {fs_image} back to snapshot '{name}'.")
 
 if __name__ == "__main__":
     fs_image = "sample.dat"
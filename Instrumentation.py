@@ -0,0 +1,163 @@
+import functools
+import threading
+import time
+
+# Operations timed on the FileSystem itself: the public API first, then
+# the helpers underneath it.
+FILESYSTEM_METHODS = [
+    'createFile', 'read_bytes', 'readFile', 'read_range', 'deleteFile', 'mkdir', 'move',
+    'chdir', 'listdir', 'open', 'resolve', 'sync', 'snapshot', 'delete_snapshot', 'rollback',
+    'read_inode', 'write_inode', 'read_inode_table',
+    '_alloc_inode', '_free_inode', '_alloc_extents', '_free_extents', '_free_blocks',
+    '_flush_bitmaps', '_read_bucket', '_write_bucket', '_dir_lookup', '_grow_directory',
+    '_read_at', '_write_at', '_write_shared', '_unref_extents',
+]
+BITMAP_METHODS = ['allocate', 'find_run', 'free_run_at', 'set_range', 'clear_range', 'take_dirty']
+
+# Latency histogram buckets: bucket i counts calls that took less than 2**i microseconds
+HISTOGRAM_BUCKETS = 24
+
+
+class Instrumentation:
+    """Opt-in counters and latency histograms for one mounted FileSystem.
+
+    attach() replaces the timed methods on the FileSystem, its bitmaps and
+    its block cache with wrappers stored on those instances; detach()
+    deletes them again, so an uninstrumented mount runs the plain class
+    methods with no overhead at all. Physical image I/O is counted in
+    calls and bytes: the block cache's reads on a miss, its write-backs
+    and bypassing transfers, and the journal's log and header writes (on a
+    memory-mapped image, every access through the mapping). An access that
+    does not start where the previous one ended is counted as a seek.
+    Usable as a context manager for scoped profiling:
+
+        with Instrumentation(fs) as probe:
+            fs.createFile('a', 'data')
+        print(probe.stats())
+    """
+
+    def __init__(self, fs):
+        self.fs = fs
+        self.lock = threading.Lock()
+        self.wrapped = []  # (object, attribute name)
+        self.reset()
+
+    def __enter__(self):
+        self.attach()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.detach()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}  # operation -> [calls, total ns, errors, histogram]
+            self.io = {'reads': 0, 'writes': 0, 'bytes_read': 0, 'bytes_written': 0, 'seeks': 0}
+            self._position = None
+
+    def attach(self):
+        if self.wrapped:
+            return
+        for name in FILESYSTEM_METHODS:
+            if hasattr(self.fs, name):
+                self._wrap(self.fs, name, name)
+        for prefix, bitmap in (('inode_bitmap', self.fs.inode_bitmap), ('block_bitmap', self.fs.block_bitmap)):
+            for name in BITMAP_METHODS:
+                self._wrap(bitmap, name, f'{prefix}.{name}')
+        if hasattr(self.fs.cache, '_pread'):
+            self._wrap_io(self.fs.cache, '_pread', False, False)
+            self._wrap_io(self.fs.cache, '_pwrite', True, False)
+        else:
+            for name, writing in (('read', False), ('view', False), ('write', True)):
+                self._wrap_io(self.fs.cache, name, writing, True)
+        if self.fs.journal is not None:
+            self._wrap(self.fs.journal, 'commit', 'journal.commit')
+            self._wrap_io(self.fs.journal, '_pwrite', True, False)
+
+    def detach(self):
+        for obj, name in self.wrapped:
+            delattr(obj, name)
+        self.wrapped = []
+
+    def _record(self, operation, elapsed, failed):
+        with self.lock:
+            entry = self.calls.get(operation)
+            if entry is None:
+                entry = self.calls[operation] = [0, 0, 0, [0] * HISTOGRAM_BUCKETS]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] += failed
+            bucket = min((elapsed // 1000).bit_length(), HISTOGRAM_BUCKETS - 1)
+            entry[3][bucket] += 1
+
+    def _wrap(self, obj, name, operation):
+        method = getattr(obj, name)
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter_ns()
+            failed = True
+            try:
+                result = method(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self._record(operation, time.perf_counter_ns() - start, failed)
+
+        setattr(obj, name, wrapper)
+        self.wrapped.append((obj, name))
+
+    def _wrap_io(self, obj, name, writing, offset_first):
+        """Count calls of an I/O method taking (offset, data or size), or the reverse."""
+        method = getattr(obj, name)
+
+        @functools.wraps(method)
+        def wrapper(first, second):
+            offset, data_or_size = (first, second) if offset_first else (second, first)
+            size = len(data_or_size) if writing else data_or_size
+            with self.lock:
+                if self._position is not None and offset != self._position:
+                    self.io['seeks'] += 1
+                self._position = offset + size
+                if writing:
+                    self.io['writes'] += 1
+                    self.io['bytes_written'] += size
+                else:
+                    self.io['reads'] += 1
+                    self.io['bytes_read'] += size
+            return method(first, second)
+
+        setattr(obj, name, wrapper)
+        self.wrapped.append((obj, name))
+
+    def stats(self):
+        """Snapshot of per-operation counts and latencies, image I/O and cache counters."""
+        with self.lock:
+            operations = {}
+            for operation, (calls, total, errors, histogram) in self.calls.items():
+                operations[operation] = {
+                    'calls': calls,
+                    'errors': errors,
+                    'total_ms': total / 1e6,
+                    'mean_us': total / calls / 1000,
+                    'p50_us': _percentile(histogram, calls, 0.50),
+                    'p99_us': _percentile(histogram, calls, 0.99),
+                    'histogram_us': {f'<{1 << i}': count for i, count in enumerate(histogram) if count},
+                }
+            return {'operations': operations, 'io': dict(self.io), 'cache': self.fs.cache.stats()}
+
+
+def _percentile(histogram, calls, fraction):
+    """Upper bound, in microseconds, of the bucket holding the given fraction of calls."""
+    wanted = fraction * calls
+    seen = 0
+    for i, count in enumerate(histogram):
+        seen += count
+        if seen >= wanted:
+            return 1 << i
+    return 1 << (len(histogram) - 1)
+
+
+def profile(fs):
+    """Context manager that instruments fs for the duration of a with block."""
+    return Instrumentation(fs)
@@ -0,0 +1,208 @@
+import os
+import struct
+import threading
+import zlib
+
+# Journal region layout: block 0 is the header (magic, sequence number of
+# the next transaction, state). A transaction is written from block 1 on as
+# a descriptor (magic, sequence, block count, home block numbers) taking as
+# many blocks as the home numbers need, one image per logged block, then a
+# commit block (magic, sequence, crc32 over the descriptor and images).
+JOURNAL_HEADER = struct.Struct('<4sQI')
+JOURNAL_DESCRIPTOR = struct.Struct('<4sQI')
+JOURNAL_COMMIT = struct.Struct('<4sQI')
+JOURNAL_MAGIC = b'JRNL'
+DESCRIPTOR_MAGIC = b'JDSC'
+COMMIT_MAGIC = b'JCMT'
+STATE_CLEAN = 0
+STATE_LOGGED = 1
+
+
+def descriptor_blocks(count, block_size):
+    return -(-(JOURNAL_DESCRIPTOR.size + 4 * count) // block_size)
+
+
+def journal_capacity(blocks, block_size):
+    """The most blocks one transaction can log in a journal region of blocks."""
+    count = blocks - 3
+    while count > 0 and 2 + descriptor_blocks(count, block_size) + count > blocks:
+        count -= 1
+    return max(count, 0)
+
+
+def write_journal_header(f, start, block_size, sequence=1, state=STATE_CLEAN):
+    f.seek(start * block_size)
+    f.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, sequence, state).ljust(block_size, b'\x00'))
+
+
+def replay_journal(fd, start, blocks, block_size):
+    """Apply a committed but not yet checkpointed transaction.
+
+    Returns the number of blocks written home. A transaction whose commit
+    block is missing or fails its checksum never reached its home
+    locations and is simply discarded.
+    """
+    if not blocks:
+        return 0
+    magic, sequence, state = JOURNAL_HEADER.unpack_from(
+        os.pread(fd, block_size, start * block_size))
+    if magic != JOURNAL_MAGIC or state != STATE_LOGGED:
+        return 0
+    descriptor = os.pread(fd, block_size, (start + 1) * block_size)
+    magic, logged_sequence, count = JOURNAL_DESCRIPTOR.unpack_from(descriptor)
+    replayed = 0
+    if magic == DESCRIPTOR_MAGIC and logged_sequence == sequence and count <= journal_capacity(blocks, block_size):
+        first_image = start + 1 + descriptor_blocks(count, block_size)
+        descriptor = os.pread(fd, (first_image - start - 1) * block_size, (start + 1) * block_size)
+        homes = struct.unpack_from('<%dI' % count, descriptor, JOURNAL_DESCRIPTOR.size)
+        images = os.pread(fd, count * block_size, first_image * block_size)
+        commit = os.pread(fd, block_size, (first_image + count) * block_size)
+        magic, commit_sequence, checksum = JOURNAL_COMMIT.unpack_from(commit)
+        if (magic == COMMIT_MAGIC and commit_sequence == sequence
+                and zlib.crc32(images, zlib.crc32(descriptor)) == checksum):
+            for i, home in enumerate(homes):
+                os.pwrite(fd, images[i * block_size:(i + 1) * block_size], home * block_size)
+            replayed = count
+    os.fsync(fd)
+    os.pwrite(fd, JOURNAL_HEADER.pack(JOURNAL_MAGIC, sequence + 1, STATE_CLEAN), start * block_size)
+    os.fsync(fd)
+    return replayed
+
+
+class Journal:
+    """Write-ahead journal for metadata blocks.
+
+    Metadata writes are held as whole-block images in the running
+    transaction instead of going to the block cache; reads of those blocks
+    see the pending images. Operations join the running transaction until
+    group_commit of them have finished (operation_done() then reports that
+    a commit is due) or sync() is called, and the whole group is then
+    committed with one log write:
+
+    1. flush dirty data blocks and fsync (ordered mode: data before metadata)
+    2. write descriptor, block images and commit record, fsync
+    3. write the images to their home blocks, fsync
+    4. mark the journal clean, fsync
+
+    A commit is due once the transaction fills half the log, so an
+    operation that checks has_room() before a large update can fail
+    cleanly instead of outgrowing it. The journal never commits on its
+    own: the caller commits only between operations. A transaction that
+    still ends up larger than the log is committed in log-sized pieces,
+    and only those pieces are atomic.
+    """
+
+    def __init__(self, cache, fd, start, blocks, block_size, group_commit=32):
+        self.cache = cache
+        self.fd = fd
+        self.start = start
+        self.block_size = block_size
+        self.group_commit = group_commit
+        self.capacity = journal_capacity(blocks, block_size)
+        if self.capacity < 1:
+            raise ValueError("Journal region is too small.")
+        header = os.pread(fd, JOURNAL_HEADER.size, start * block_size)
+        _, self.sequence, _ = JOURNAL_HEADER.unpack(header)
+        self.pending = {}  # home block number -> bytearray image
+        self.operations = 0
+        self.commits = 0
+        self.lock = threading.RLock()
+
+    def _pwrite(self, data, offset):
+        os.pwrite(self.fd, data, offset)
+
+    def _image(self, block_num):
+        image = self.pending.get(block_num)
+        if image is None:
+            image = bytearray(self.cache.read(block_num * self.block_size, self.block_size))
+            self.pending[block_num] = image
+        return image
+
+    def write(self, offset, data):
+        with self.lock:
+            self._write(offset, data)
+
+    def _write(self, offset, data):
+        view = memoryview(data)
+        block_num, start = divmod(offset, self.block_size)
+        while len(view):
+            count = min(self.block_size - start, len(view))
+            self._image(block_num)[start:start + count] = view[:count]
+            view = view[count:]
+            block_num += 1
+            start = 0
+
+    def read(self, offset, size):
+        if not self.pending:
+            return self.cache.read(offset, size)
+        with self.lock:
+            return self._read(offset, size)
+
+    def _read(self, offset, size):
+        first = offset // self.block_size
+        last = (offset + size - 1) // self.block_size
+        if not any(n in self.pending for n in range(first, last + 1)):
+            return self.cache.read(offset, size)
+        data = bytearray(self.cache.read(first * self.block_size, (last - first + 1) * self.block_size))
+        for n in range(first, last + 1):
+            image = self.pending.get(n)
+            if image is not None:
+                data[(n - first) * self.block_size:(n - first + 1) * self.block_size] = image
+        skip = offset - first * self.block_size
+        return bytes(data[skip:skip + size])
+
+    def has_room(self, blocks):
+        """Whether the running transaction can take blocks more and still be logged at once."""
+        with self.lock:
+            return len(self.pending) + blocks <= self.capacity
+
+    def operation_done(self):
+        """Count a finished operation; return True when the group should be committed."""
+        with self.lock:
+            self.operations += 1
+            return self.commit_due()
+
+    def commit_due(self):
+        return self.operations >= self.group_commit or len(self.pending) * 2 >= self.capacity
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        self.cache.sync()
+        os.fsync(self.fd)
+        self.operations = 0
+        homes = sorted(self.pending)
+        for done in range(0, len(homes), self.capacity):
+            piece = homes[done:done + self.capacity]
+            self._log(piece)
+            self._checkpoint(piece)
+        self.pending.clear()
+
+    def _log(self, homes):
+        """Write homes' images to the log and mark it committed."""
+        block_size = self.block_size
+        descriptor = JOURNAL_DESCRIPTOR.pack(DESCRIPTOR_MAGIC, self.sequence, len(homes)) + \
+            struct.pack('<%dI' % len(homes), *homes)
+        descriptor = descriptor.ljust(descriptor_blocks(len(homes), block_size) * block_size, b'\x00')
+        images = b''.join(self.pending[n] for n in homes)
+        checksum = zlib.crc32(images, zlib.crc32(descriptor))
+        commit = JOURNAL_COMMIT.pack(COMMIT_MAGIC, self.sequence, checksum).ljust(block_size, b'\x00')
+        self._pwrite(descriptor + images + commit, (self.start + 1) * block_size)
+        self._pwrite(JOURNAL_HEADER.pack(JOURNAL_MAGIC, self.sequence, STATE_LOGGED),
+                  self.start * block_size)
+        os.fsync(self.fd)
+
+    def _checkpoint(self, homes):
+        """Write logged images to their home blocks and mark the log clean."""
+        block_size = self.block_size
+        for n in homes:
+            self.cache.write(n * block_size, self.pending[n])
+        self.cache.sync()
+        os.fsync(self.fd)
+        self.sequence += 1
+        self._pwrite(JOURNAL_HEADER.pack(JOURNAL_MAGIC, self.sequence, STATE_CLEAN),
+                  self.start * block_size)
+        os.fsync(self.fd)
+        self.commits += 1
@@ -0,0 +1,134 @@
+import threading
+from contextlib import contextmanager
+
+
+class RWLock:
+    """Reader/writer lock that lets many readers or one writer in.
+
+    Waiting writers block new readers so a steady stream of reads cannot
+    starve them. Both sides are reentrant for the owning thread, and the
+    writer may also take the read side; a reader may not upgrade.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}  # thread ident -> hold count
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers[me] = 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+            else:
+                del self._readers[me]
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            if me in self._readers:
+                raise RuntimeError("Cannot upgrade a read lock to a write lock.")
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class InodeLocks:
+    """Table of per-inode RWLocks, created on first use.
+
+    Locks on several inodes are always taken in ascending inode order so
+    two threads locking overlapping sets cannot deadlock. Entries are
+    dropped again once no thread holds or waits for them.
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._locks = {}  # inode number -> [RWLock, users]
+
+    def _get(self, inode_number):
+        with self._mutex:
+            entry = self._locks.get(inode_number)
+            if entry is None:
+                entry = self._locks[inode_number] = [RWLock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _put(self, inode_number):
+        with self._mutex:
+            entry = self._locks[inode_number]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[inode_number]
+
+    @contextmanager
+    def read(self, inode_number):
+        lock = self._get(inode_number)
+        try:
+            with lock.read_locked():
+                yield
+        finally:
+            self._put(inode_number)
+
+    @contextmanager
+    def write(self, *inode_numbers):
+        held = []
+        try:
+            for inode_number in sorted(set(inode_numbers)):
+                lock = self._get(inode_number)
+                try:
+                    lock.acquire_write()
+                except BaseException:
+                    self._put(inode_number)
+                    raise
+                held.append((inode_number, lock))
+            yield
+        finally:
+            for inode_number, lock in reversed(held):
+                lock.release_write()
+                self._put(inode_number)
@@ -1,44 +1,88 @@
-from DataStrucures import Superblock, Inode
-import pickle
+from DataStrucures import Superblock, Bitmap, Inode, INODE_SIZE, REFCOUNT, DEDUP_INDEX_ENTRY, pack_directory_bucket
+from Journal import write_journal_header
 
-def initialize_filesystem(filename, size_mb=10):
-    total_bytes = size_mb * 1024 * 1024
-    block_size = 4096
+BYTES_PER_INODE = 16384
+MIN_INODES = 128
+
+def make_superblock(total_bytes, block_size=4096, total_inodes=None, journal_blocks=None, dedup=False):
+    """Lay out an image of total_bytes: superblock, inode bitmap, inode table,
+    free-space bitmap, journal, the dedup refcount table and hash index if
+    dedup is set, then the data area starting with the root directory block."""
+    if block_size & (block_size - 1) or not 1024 <= block_size <= 32768:
+        raise ValueError("Block size must be a power of two from 1024 to 32768.")
     total_blocks = total_bytes // block_size
+    if total_inodes is None:
+        total_inodes = max(MIN_INODES, total_bytes // BYTES_PER_INODE)
+    if journal_blocks is None:
+        # About 1/64 of the image, and enough to log the growth of a
+        # directory holding every inode, within sensible bounds
+        journal_blocks = min(max(total_blocks // 64, total_inodes // 16, 64), 8192)
 
     sb = Superblock()
+    sb.block_size = block_size
     sb.total_blocks = total_blocks
+    sb.total_inodes = total_inodes
+    sb.inodes_bitmap_start = 1
+    sb.inodes_bitmap_blocks = -(-total_inodes // (block_size * 8))
+    sb.inode_table_start = sb.inodes_bitmap_start + sb.inodes_bitmap_blocks
+    sb.inode_table_blocks = -(-total_inodes * INODE_SIZE // block_size)
+    sb.free_space_map_start = sb.inode_table_start + sb.inode_table_blocks
+    # One bit per block; multi-GB images need more than one bitmap block
+    sb.free_space_map_blocks = -(-total_blocks // (block_size * 8))
+    sb.journal_start = sb.free_space_map_start + sb.free_space_map_blocks
+    sb.journal_blocks = journal_blocks
+    sb.refcount_start = sb.journal_start + sb.journal_blocks
+    sb.dedup_index_start = sb.refcount_start
+    if dedup:
+        sb.refcount_blocks = -(-total_blocks * REFCOUNT.size // block_size)
+        sb.dedup_index_start = sb.refcount_start + sb.refcount_blocks
+        # Room for a quarter more entries than there are blocks, so buckets
+        # rarely fill up
+        per_bucket = block_size // DEDUP_INDEX_ENTRY.size
+        sb.dedup_index_blocks = -(-total_blocks * 5 // 4 // per_bucket)
+    sb.data_start = sb.dedup_index_start + sb.dedup_index_blocks
+    if sb.data_start >= total_blocks:
+        raise ValueError("Image is too small for its metadata.")
+    return sb
+
+def initialize_filesystem(filename, size_mb=10, journal_blocks=None, block_size=4096, total_inodes=None,
+                          dedup=False):
+    """Create an image of size_mb megabytes.
+
+    The file is created sparse: only the superblock, bitmaps, root inode,
+    journal header and root directory bucket are written, so unwritten
+    inode slots and data blocks read back as zeros without taking space.
+    With dedup=True the image stores identical data blocks once (see
+    FileSystem); the zeroed refcount table and hash index start empty.
+    """
+    sb = make_superblock(size_mb * 1024 * 1024, block_size, total_inodes, journal_blocks, dedup)
 
     with open(filename, 'wb') as f:
+        f.truncate(sb.total_blocks * block_size)
         write_superblock(f, sb)
         # Write inode bitmap (root inode used)
-        inode_bitmap = bytearray([0] * sb.total_inodes)
-        inode_bitmap[0] = 1
-        write_inode_bitmap(f, inode_bitmap, sb.inodes_bitmap_start * block_size)
-        # Write fixed-size inode table
+        inode_bitmap = Bitmap(sb.total_inodes)
+        inode_bitmap.set(0)
+        write_inode_bitmap(f, inode_bitmap.to_bytes(), sb.inodes_bitmap_start * block_size)
+        # An all-zero inode slot is a free inode, so only the root is written
         write_inode_table(f, sb, block_size)
-        # Write free space bitmap (all free)
-        write_bitmap(f, bytearray([0] * block_size), sb.free_space_map_start * block_size)
-        # Initialize root directory block (empty list)
-        root_dir_block = 5  # First data block after bitmaps
-
-        block_bitmap = bytearray([0] * sb.block_size)  # sb.block_size = 4096
-        block_index = root_dir_block - sb.free_space_map_start - 1  # 5 - 4 - 1 = 0
-        block_bitmap[block_index] = 1  # Mark block 5 as used
-        write_bitmap(f, block_bitmap, sb.free_space_map_start * sb.block_size)
-
-        root_inode_offset = sb.inode_table_start * block_size
-        f.seek(root_inode_offset)
-        root_inode = Inode()
-        root_inode.is_directory = True
-        root_inode.direct_blocks[0] = root_dir_block
-        f.write(pickle.dumps(root_inode))
+        root_dir_block = root_directory_block(sb)  # First data block
+
+        # Metadata blocks and the root directory block are in use
+        block_bitmap = Bitmap(sb.total_blocks)
+        block_bitmap.set_range(0, root_dir_block + 1)
+        write_bitmap(f, block_bitmap.to_bytes(), sb.free_space_map_start * sb.block_size)
+
+        # An empty, clean journal
+        if sb.journal_blocks:
+            write_journal_header(f, sb.journal_start, block_size)
+
         # Write empty directory entries to root directory block
         f.seek(root_dir_block * block_size)
-        pickle.dump([], f)
+        f.write(pack_directory_bucket([], block_size))
 
-def serialize(obj):
-    return pickle.dumps(obj)
+def serialize(superblock):
+    return superblock.pack()
 
 def write_superblock(f, superblock):
     f.seek(0)
@@ -48,14 +92,18 @@ def write_inode_bitmap(f, bitmap, offset):
     f.seek(offset)
     f.write(bitmap)
 
+def root_directory_block(sb):
+    return sb.data_start
+
 def write_inode_table(f, sb, block_size):
+    # Only the root inode is written; the rest of the table is left as a
+    # hole in the sparse image and reads back as free, all-zero slots.
+    inode = Inode()
+    inode.is_directory = True
+    inode.file_size = block_size
+    inode.extents = [(root_directory_block(sb), 1)]
     f.seek(sb.inode_table_start * block_size)
-    for i in range(sb.total_inodes):
-        inode = Inode()
-        if i == 0:
-            inode.is_directory = True
-            inode.direct_blocks[0] = 5  # Root directory block
-        f.write(serialize(inode))
+    f.write(inode.pack())
 
 def write_bitmap(f, bitmap, offset):
     f.seek(offset)
@@ -0,0 +1,215 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from FileOperations import FileSystem
+
+
+class AsyncFileSystem:
+    """asyncio front end for a mounted FileSystem.
+
+    Every call that touches the image runs on a ThreadPoolExecutor of
+    max_workers threads, with at most max_pending calls submitted at once,
+    so the event loop never blocks on disk I/O. Concurrent reads of the
+    same range of the same inode share one read; a write, truncate or
+    delete of an inode stops later reads from joining a read that started
+    before it. Extra keyword arguments are passed to FileSystem.
+
+        async with AsyncFileSystem('sample.dat') as fs:
+            await fs.create('notes.txt', 'hello')
+            data = await fs.read('notes.txt')
+    """
+
+    def __init__(self, fs_image, max_workers=4, max_pending=64, **options):
+        self.fs_image = fs_image
+        self.options = options
+        self.fs = None
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='aiovfs')
+        self._slots = asyncio.Semaphore(max_pending)
+        self._reads = {}  # (inode number, offset, size) -> future
+        self.reads_issued = 0
+        self.reads_coalesced = 0
+
+    async def __aenter__(self):
+        return await self.mount()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def mount(self):
+        if self.fs is None:
+            self.fs = await self._run(FileSystem, self.fs_image, **self.options)
+        return self
+
+    async def close(self):
+        if self.fs is not None:
+            await self._run(self.fs.close)
+            self.fs = None
+        self._executor.shutdown(wait=False)
+
+    async def sync(self):
+        await self._run(self.fs.sync)
+
+    async def _run(self, func, *args, **kwargs):
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _read_range(self, inode_number, offset, size):
+        key = (inode_number, offset, size)
+        future = self._reads.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._run(self.fs.read_range, inode_number, offset, size))
+            self._reads[key] = future
+            future.add_done_callback(functools.partial(self._read_done, key))
+            self.reads_issued += 1
+        else:
+            self.reads_coalesced += 1
+        # Shielded so one cancelled caller does not cancel the read for the others
+        return await asyncio.shield(future)
+
+    def _read_done(self, key, future):
+        if self._reads.get(key) is future:
+            del self._reads[key]
+
+    def _invalidate(self, inode_number):
+        for key in [key for key in self._reads if key[0] == inode_number]:
+            del self._reads[key]
+
+    async def _resolve_existing(self, path):
+        try:
+            return await self._run(self.fs.resolve, path)
+        except FileNotFoundError:
+            return None
+
+    # Operations
+
+    async def create(self, path, content=b''):
+        """Create a new file with content (str is UTF-8 encoded); return its inode number."""
+        return await self._run(self.fs.createFile, path, content)
+
+    async def read(self, path):
+        inode_number = await self._run(self.fs.resolve, path)
+        return await self._read_range(inode_number, 0, -1)
+
+    async def write(self, path, data):
+        """Replace the contents of path with data, creating it if needed."""
+        inode_number = await self._resolve_existing(path)
+        if inode_number is not None:
+            self._invalidate(inode_number)
+        inode_number = await self._run(self._write_file, path, data)
+        self._invalidate(inode_number)
+        return len(data)
+
+    def _write_file(self, path, data):
+        with self.fs.open(path, 'w') as file_object:
+            file_object.write(data)
+        return file_object.inode_number
+
+    async def delete(self, path):
+        inode_number = await self._resolve_existing(path)
+        await self._run(self.fs.deleteFile, path)
+        if inode_number is not None:
+            self._invalidate(inode_number)
+
+    async def mkdir(self, path):
+        return await self._run(self.fs.mkdir, path)
+
+    async def listdir(self, path='.'):
+        return await self._run(self.fs.listdir, path)
+
+    async def move(self, source_path, target_dir_path):
+        await self._run(self.fs.move, source_path, target_dir_path)
+
+    async def open(self, path, mode='r'):
+        file_object = await self._run(self.fs.open, path, mode)
+        if 'w' in mode:
+            self._invalidate(file_object.inode_number)
+        return AsyncFile(self, file_object)
+
+    def stats(self):
+        return {
+            'reads_issued': self.reads_issued,
+            'reads_coalesced': self.reads_coalesced,
+            'reads_in_flight': len(self._reads),
+        }
+
+
+class AsyncFile:
+    """Async handle returned by AsyncFileSystem.open().
+
+    Wraps a FileObject; the position is tracked here so reads can be
+    coalesced with those of other handles on the same inode. Writes are
+    flushed as they happen so those reads always see them.
+    """
+
+    def __init__(self, afs, file_object):
+        self.afs = afs
+        self.file_object = file_object
+        self.inode_number = file_object.inode_number
+        self.offset = file_object.offset
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self, size=None):
+        size = size or self.afs.fs.sb.block_size * 16
+        while True:
+            data = await self.read(size)
+            if not data:
+                return
+            yield data
+
+    async def read(self, size=-1):
+        self.file_object._check_open()
+        if not self.file_object.readable():
+            raise OSError("File not open for reading.")
+        data = await self.afs._read_range(self.inode_number, self.offset,
+                                          -1 if size is None else size)
+        self.offset += len(data)
+        return data
+
+    async def write(self, data):
+        self.afs._invalidate(self.inode_number)
+        written = await self.afs._run(self._write, data)
+        self.afs._invalidate(self.inode_number)
+        return written
+
+    def _write(self, data):
+        self.file_object.seek(self.offset)
+        written = self.file_object.write(data)
+        self.file_object.flush()
+        self.offset = self.file_object.tell()
+        return written
+
+    def seek(self, offset, whence=0):
+        self.file_object.seek(self.offset)
+        self.offset = self.file_object.seek(offset, whence)
+        return self.offset
+
+    def tell(self):
+        return self.offset
+
+    async def truncate(self, size=None):
+        size = self.offset if size is None else size
+        self.afs._invalidate(self.inode_number)
+        size = await self.afs._run(self._truncate, size)
+        self.afs._invalidate(self.inode_number)
+        return size
+
+    def _truncate(self, size):
+        size = self.file_object.truncate(size)
+        self.file_object.flush()
+        return size
+
+    async def flush(self):
+        await self.afs._run(self.file_object.flush)
+
+    async def close(self):
+        await self.afs._run(self.file_object.close)
@@ -0,0 +1,117 @@
+import os
+
+import pytest
+
+from FileOperations import FileSystem
+from FileSystemCheck import check_filesystem
+from Journal import replay_journal
+from SystemInitializer import initialize_filesystem
+
+
+@pytest.fixture
+def image(tmp_path):
+    path = str(tmp_path / 'fs.dat')
+    initialize_filesystem(path, 4)
+    return path
+
+
+def crash_after_log(fs):
+    """Log the running transaction, then stop as if the machine lost power before the checkpoint."""
+    fs._flush_bitmaps()
+    fs.cache.sync()
+    fs.journal._log(sorted(fs.journal.pending))
+    fs.fs.close()
+
+
+def crash(fs):
+    """Stop without committing the running transaction; data already flushed stays on disk."""
+    fs.cache.sync()
+    fs.fs.close()
+
+
+def test_logged_transaction_is_replayed(image):
+    fs = FileSystem(image)
+    fs.mkdir('d')
+    fs.createFile('d/f', 'journaled')
+    crash_after_log(fs)
+    with FileSystem(image) as fs:
+        assert fs.readFile('d/f') == 'journaled'
+    assert check_filesystem(image).clean
+
+
+def test_torn_commit_is_discarded(image):
+    with FileSystem(image) as fs:
+        fs.createFile('kept', 'before')
+    fs = FileSystem(image)
+    fs.createFile('lost', 'after')
+    sb = fs.sb
+    crash_after_log(fs)
+    # Damage the first logged image so the commit checksum no longer matches
+    with open(image, 'r+b') as f:
+        f.seek((sb.journal_start + 2) * sb.block_size)
+        f.write(b'torn')
+    with FileSystem(image) as fs:
+        assert fs.readFile('kept') == 'before'
+        assert fs.listdir('/') == ['kept']
+    assert check_filesystem(image).clean
+
+
+def test_large_transaction_replays(tmp_path):
+    # More homes than one descriptor block can list
+    path = str(tmp_path / 'fs.dat')
+    initialize_filesystem(path, 4, journal_blocks=400, block_size=1024)
+    fs = FileSystem(path)
+    count = 300
+    assert fs.journal.capacity >= count
+    for n in range(count):
+        fs._write((fs.sb.data_start + n) * fs.sb.block_size, bytes([n % 251 + 1]) * fs.sb.block_size)
+    sb = fs.sb
+    crash_after_log(fs)
+    fd = os.open(path, os.O_RDWR)
+    try:
+        assert replay_journal(fd, sb.journal_start, sb.journal_blocks, sb.block_size) == count
+        for n in range(count):
+            block = os.pread(fd, sb.block_size, (sb.data_start + n) * sb.block_size)
+            assert block == bytes([n % 251 + 1]) * sb.block_size
+    finally:
+        os.close(fd)
+
+
+def test_freed_blocks_wait_for_commit(image):
+    with FileSystem(image) as fs:
+        fs.createFile('C', 'c' * 100)
+        fs.createFile('A', 'a' * 100)
+    fs = FileSystem(image)
+    fs.deleteFile('A')
+    with fs.open('C', 'a') as f:
+        f.write(b'X' * 4096)
+    # The data flush of the next commit happens, the log write never does
+    crash(fs)
+    with FileSystem(image) as fs:
+        assert fs.readFile('A') == 'a' * 100
+        assert fs.readFile('C') == 'c' * 100
+    assert check_filesystem(image).clean
+
+
+def test_directory_growth_fails_cleanly(tmp_path):
+    path = str(tmp_path / 'fs.dat')
+    initialize_filesystem(path, 4, journal_blocks=16, total_inodes=4096)
+    with FileSystem(path) as fs:
+        with pytest.raises(OSError, match='journal'):
+            for n in range(4000):
+                fs.createFile(f'file-with-a-longer-name-{n:05d}', '')
+        created = len(fs.listdir('/'))
+    assert check_filesystem(path).clean
+    with FileSystem(path) as fs:
+        assert len(fs.listdir('/')) == created
+
+
+def test_journal_never_commits_mid_operation(image):
+    fs = FileSystem(image)
+    journal = fs.journal
+    for n in range(journal.capacity + 10):
+        journal.write((fs.sb.data_start + n) * fs.sb.block_size, b'x')
+    assert journal.commits == 0
+    assert len(journal.pending) == journal.capacity + 10
+    journal.pending.clear()
+    fs.close()